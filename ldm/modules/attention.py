@@ -1,14 +1,21 @@
-import os
+import os, threading, time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from inspect import isfunction
 import math
 import torch
 import torch.nn.functional as F
 from torch import nn, einsum
 from einops import rearrange, repeat
-from typing import Any, Optional
 
 from ldm.modules.diffusionmodules.util import checkpoint
 
+try:
+    import xformers
+    import xformers.ops
+except ImportError:
+    xformers = None
+
 
 def exists(val):
     return val is not None
@@ -171,8 +178,313 @@ class SpatialSelfAttention(nn.Module):
         return x+h_
 
 
+def online_softmax_attention(q, k, v, scale, query_chunk, key_chunk=None):
+    """
+    softmax(q @ k * scale) @ v without materializing the full score matrix.
+    Queries are processed in chunks of query_chunk rows and keys in chunks
+    of key_chunk columns, with a running max and sum per row keeping the
+    softmax numerically stable.
+    :param q: b, n, c
+    :param k: b, c, m
+    :param v: b, m, c
+    :return: b, n, c
+    """
+    b, n, _ = q.shape
+    m = k.shape[2]
+    key_chunk = key_chunk or m
+    out = torch.empty((b, n, v.shape[2]), dtype=v.dtype, device=v.device)
+    for i in range(0, n, query_chunk):
+        q_i = q[:, i:i + query_chunk] * scale
+        run_max = run_sum = acc = None
+        for j in range(0, m, key_chunk):
+            s = torch.bmm(q_i, k[:, :, j:j + key_chunk]).float()
+            new_max = s.amax(dim=2, keepdim=True)
+            if run_max is not None:
+                new_max = torch.maximum(run_max, new_max)
+            p = torch.exp(s - new_max)
+            del s
+            p_v = torch.bmm(p.to(v.dtype), v[:, j:j + key_chunk]).float()
+            if run_max is None:
+                run_sum = p.sum(dim=2, keepdim=True)
+                acc = p_v
+            else:
+                correction = torch.exp(run_max - new_max)
+                run_sum = run_sum * correction + p.sum(dim=2, keepdim=True)
+                acc = acc * correction + p_v
+            del p, p_v
+            run_max = new_max
+        out[:, i:i + query_chunk] = (acc / run_sum).to(v.dtype)
+        del q_i, run_max, run_sum, acc
+    return out
+
+
+# Attention backends. Every backend computes softmax(q k^T * scale) v for
+# q of shape (b*heads, n, d) and k, v of shape (b*heads, m, d). memory
+# estimates the bytes a call needs on top of its inputs.
+AttentionBackend = namedtuple("AttentionBackend", ["fn", "available", "memory"])
+ATTENTION_BACKENDS = {}
+
+# backend used by CrossAttention modules which don't set their own
+ATTENTION_BACKEND = "auto"
+
+# queries per chunk of the "chunked" backend
+QUERY_CHUNK = 1024
+
+# memory the autotuner lets a backend use on the CPU, there is no cheap way
+# to ask how much is free and timing a naive score matrix of a large image
+# would swap the machine to a halt
+CPU_ATTENTION_MEMORY = 2**30
+
+
+def register_attention_backend(name, available=lambda q: True, memory=lambda q, k, v, att_step=1: 0):
+    def decorator(fn):
+        ATTENTION_BACKENDS[name] = AttentionBackend(fn, available, memory)
+        return fn
+    return decorator
+
+
+def set_attention_backend(name):
+    global ATTENTION_BACKEND
+    if name != "auto" and name not in ATTENTION_BACKENDS:
+        raise ValueError(f"unknown attention backend '{name}'")
+    ATTENTION_BACKEND = name
+
+
+@register_attention_backend(
+    "naive",
+    memory=lambda q, k, v, att_step=1: 2 * q.shape[0] * q.shape[1] * k.shape[1] * q.element_size())
+def naive_attention(q, k, v, scale, att_step=1):
+    sim = einsum('b i d, b j d -> b i j', q, k) * scale
+    sim1 = sim.softmax(dim=-1)
+    del sim
+    return einsum('b i j, b j d -> b i d', sim1, v)
+
+
+@register_attention_backend(
+    "sliced",
+    # scores of one slice of att_step batch*heads rows, plus the fp32 output
+    memory=lambda q, k, v, att_step=1: (2 * q.shape[0] * q.shape[1] * k.shape[1] * q.element_size()
+                                        // max(q.shape[0] // att_step, 1)
+                                        + 4 * q.shape[0] * q.shape[1] * v.shape[2]))
+def sliced_attention(q1, k1, v1, scale, att_step=1):
+    limit = k1.shape[0]
+    q_chunks = list(torch.tensor_split(q1, limit // att_step, dim=0))
+    k_chunks = list(torch.tensor_split(k1, limit // att_step, dim=0))
+    v_chunks = list(torch.tensor_split(v1, limit // att_step, dim=0))
+    q_chunks.reverse()
+    k_chunks.reverse()
+    v_chunks.reverse()
+
+    sim = torch.zeros(q1.shape[0],
+                      q1.shape[1],
+                      v1.shape[2],
+                      device=q1.device)
+    del k1, q1, v1
+
+    for i in range (0, limit, att_step):
+        q_buffer = q_chunks.pop()
+        k_buffer = k_chunks.pop()
+        v_buffer = v_chunks.pop()
+        sim_buffer = einsum('b i d, b j d -> b i j',
+                            q_buffer,
+                            k_buffer) * scale
+        del k_buffer, q_buffer
+
+        # attention, what we cannot get enough of, by chunks
+        sim_buffer1 = sim_buffer.softmax(dim=-1)
+        del sim_buffer
+
+        sim_buffer2 = einsum('b i j, b j d -> b i d',
+                             sim_buffer1,
+                             v_buffer)
+        del sim_buffer1, v_buffer
+
+        sim[i:i+att_step,:,:] = sim_buffer2
+        del sim_buffer2
+    return sim
+
+
+@register_attention_backend(
+    "chunked",
+    memory=lambda q, k, v, att_step=1: 3 * 4 * q.shape[0] * min(QUERY_CHUNK, q.shape[1]) * k.shape[1])
+def chunked_attention(q, k, v, scale, att_step=1):
+    return online_softmax_attention(q, k.transpose(1, 2), v, scale, QUERY_CHUNK)
+
+
+@register_attention_backend(
+    "sdp",
+    available=lambda q: hasattr(F, "scaled_dot_product_attention"),
+    memory=lambda q, k, v, att_step=1: q.shape[0] * q.shape[1] * v.shape[2] * q.element_size())
+def sdp_attention(q, k, v, scale, att_step=1):
+    # it scales by d**-0.5 by itself
+    if scale != q.shape[-1] ** -0.5:
+        q = q * (scale * q.shape[-1] ** 0.5)
+    return F.scaled_dot_product_attention(q, k, v)
+
+
+@register_attention_backend(
+    "xformers",
+    available=lambda q: xformers is not None and q.device.type == "cuda",
+    memory=lambda q, k, v, att_step=1: q.shape[0] * q.shape[1] * v.shape[2] * q.element_size())
+def xformers_attention(q, k, v, scale, att_step=1):
+    if scale != q.shape[-1] ** -0.5:
+        q = q * (scale * q.shape[-1] ** 0.5)
+    return xformers.ops.memory_efficient_attention(q.contiguous(),
+                                                   k.contiguous(),
+                                                   v.contiguous(),
+                                                   attn_bias=None)
+
+
+class AttentionAutotuner:
+    """
+    Picks the backend for a shape the first time it is seen: every
+    available backend whose memory estimate fits into free device memory
+    (CPU_ATTENTION_MEMORY on the CPU) is timed on the actual inputs and the fastest one is kept for
+    (sequence lengths, batch*heads, head dim, dtype, device, att_step).
+    """
+    def __init__(self, repeats=2):
+        self.repeats = repeats
+        self.choices = {}
+        self.lock = threading.Lock()
+
+    def key(self, q, k, att_step=1):
+        return (q.shape[1], k.shape[1], q.shape[0], q.shape[2], q.dtype, q.device.type, att_step)
+
+    def free_memory(self, device):
+        if device.type == "cpu":
+            return CPU_ATTENTION_MEMORY
+        if device.type != "cuda":
+            return None
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+    def synchronize(self, device):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def measure(self, fn, q, k, v, scale, att_step=1):
+        fn(q, k, v, scale, att_step)
+        self.synchronize(q.device)
+        tic = time.perf_counter()
+        for _ in range(self.repeats):
+            fn(q, k, v, scale, att_step)
+        self.synchronize(q.device)
+        return (time.perf_counter() - tic) / self.repeats
+
+    def select(self, q, k, v, scale, att_step=1):
+        key = self.key(q, k, att_step)
+        choice = self.choices.get(key)
+        if choice is not None:
+            return choice
+        with self.lock:
+            if key in self.choices:
+                return self.choices[key]
+            free = self.free_memory(q.device)
+            timings = {}
+            for name, backend in ATTENTION_BACKENDS.items():
+                if not backend.available(q):
+                    continue
+                if free is not None and backend.memory(q, k, v, att_step) > free:
+                    continue
+                try:
+                    timings[name] = self.measure(backend.fn, q, k, v, scale, att_step)
+                except RuntimeError as e:
+                    if "out of memory" not in str(e):
+                        raise
+                    torch.cuda.empty_cache()
+            if timings:
+                choice = min(timings, key=timings.get)
+            else:
+                # nothing seems to fit, go with the smallest footprint
+                choice = min((name for name, backend in ATTENTION_BACKENDS.items()
+                              if backend.available(q)),
+                             key=lambda name: ATTENTION_BACKENDS[name].memory(q, k, v, att_step))
+            self.choices[key] = choice
+            return choice
+
+
+autotuner = AttentionAutotuner()
+
+
+class KVCache:
+    """
+    Keys and values of cross attention for one sampling run.
+
+    The conditioning doesn't change while sampling, so to_k/to_v only have
+    to run once per context tensor and attention module. Entries are keyed
+    on the address, shape, strides and version of the context and keep a
+    reference to it, so no other tensor can take its memory while the
+    entry lives. Every module keeps its max_contexts latest contexts.
+    """
+    def __init__(self, max_contexts=4):
+        self.max_contexts = max_contexts
+        self.entries = {}
+        self.conditionings = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, context):
+        return (context.data_ptr(), tuple(context.shape), context.stride(),
+                context.dtype, context.device, context._version,
+                torch.is_autocast_enabled())
+
+    def get(self, module, context):
+        entries = self.entries.setdefault(id(module), OrderedDict())
+        key = self.key(context)
+        entry = entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            entries.move_to_end(key)
+            return entry[1], entry[2]
+        self.misses += 1
+        k = module.to_k(context)
+        v = module.to_v(context)
+        entries[key] = (context, k, v)
+        while len(entries) > self.max_contexts:
+            entries.popitem(last=False)
+        return k, v
+
+    def concat(self, uc, c):
+        """torch.cat([uc, c]) which returns the same tensor for the same inputs"""
+        if self.conditionings is None or self.conditionings[0] is not uc or self.conditionings[1] is not c:
+            self.conditionings = (uc, c, torch.cat([uc, c]))
+        return self.conditionings[2]
+
+
+_kv_session = threading.local()
+
+
+@contextmanager
+def kv_cache_session(max_contexts=4):
+    """caches cross attention keys and values of the current thread"""
+    previous = getattr(_kv_session, "cache", None)
+    _kv_session.cache = KVCache(max_contexts)
+    try:
+        yield _kv_session.cache
+    finally:
+        _kv_session.cache = previous
+
+
+def current_kv_cache():
+    return getattr(_kv_session, "cache", None)
+
+
+def cfg_conditioning(uc, c):
+    """
+    conditioning of a classifier free guidance step, within a session the
+    same tensor on every step so cached keys and values are found again
+    """
+    if uc.shape[1:] != c.shape[1:]:
+        raise ValueError(f"conditioning {tuple(c.shape)} and unconditional conditioning {tuple(uc.shape)} "
+                         "need the same number of tokens, encode the prompts together")
+    cache = current_kv_cache()
+    if cache is None:
+        return torch.cat([uc, c])
+    return cache.concat(uc, c)
+
+
 class CrossAttention(nn.Module):
-    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., att_step=1):
+    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., att_step=1, backend=None):
         super().__init__()
         inner_dim = dim_head * heads
         context_dim = default(context_dim, query_dim)
@@ -180,6 +492,8 @@ class CrossAttention(nn.Module):
         self.scale = dim_head ** -0.5
         self.heads = heads
         self.att_step = att_step
+        # None follows ATTENTION_BACKEND
+        self.backend = backend
 
         self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
         self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
@@ -192,9 +506,13 @@ class CrossAttention(nn.Module):
         h = self.heads
 
         q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        v = self.to_v(context)
+        cache = current_kv_cache()
+        if context is not None and cache is not None:
+            k, v = cache.get(self, context)
+        else:
+            context = default(context, x)
+            k = self.to_k(context)
+            v = self.to_v(context)
         del context, x
 
         q1, k1, v1 = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h),
@@ -202,41 +520,11 @@ class CrossAttention(nn.Module):
         del q, k, v
 
 
-        limit = k1.shape[0]
-        att_step = self.att_step
-        q_chunks = list(torch.tensor_split(q1, limit // att_step, dim=0))
-        k_chunks = list(torch.tensor_split(k1, limit // att_step, dim=0))
-        v_chunks = list(torch.tensor_split(v1, limit // att_step, dim=0))
-        q_chunks.reverse()
-        k_chunks.reverse()
-        v_chunks.reverse()
-
-        sim = torch.zeros(q1.shape[0],
-                          q1.shape[1],
-                          v1.shape[2],
-                          device=q1.device)
-        del k1, q1, v1
-
-        for i in range (0, limit, att_step):
-            q_buffer = q_chunks.pop()
-            k_buffer = k_chunks.pop()
-            v_buffer = v_chunks.pop()
-            sim_buffer = einsum('b i d, b j d -> b i j',
-                                q_buffer,
-                                k_buffer) * self.scale
-            del k_buffer, q_buffer
-
-            # attention, what we cannot get enough of, by chunks
-            sim_buffer1 = sim_buffer.softmax(dim=-1)
-            del sim_buffer
-
-            sim_buffer2 = einsum('b i j, b j d -> b i d',
-                                 sim_buffer1,
-                                 v_buffer)
-            del sim_buffer1, v_buffer
-
-            sim[i:i+att_step,:,:] = sim_buffer2
-            del sim_buffer2
+        backend = self.backend or ATTENTION_BACKEND
+        if backend == "auto":
+            backend = autotuner.select(q1, k1, v1, self.scale, self.att_step)
+        sim = ATTENTION_BACKENDS[backend].fn(q1, k1, v1, self.scale, self.att_step)
+        del q1, k1, v1
 
         sim1 = rearrange(sim, '(b h) n d -> b n (h d)', h=h)
         del sim
@@ -245,79 +533,37 @@ class CrossAttention(nn.Module):
         return sim2
 
 
-class MemoryEfficientCrossAttention(nn.Module):
-     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.0):
-         super().__init__()
-         inner_dim = dim_head * heads
-         context_dim = default(context_dim, query_dim)
-
-         self.heads = heads
-         self.dim_head = dim_head
-
-         self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
-         self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
-         self.to_v = nn.Linear(context_dim, inner_dim, bias=False)
-
-         self.to_out = nn.Sequential(nn.Linear(inner_dim, query_dim), nn.Dropout(dropout))
-         self.attention_op: Optional[Any] = None
-
-     def forward(self, x, context=None, mask=None):
-         q_in = self.to_q(x)
-         context = default(context, x)
-         k_in = self.to_k(context)
-         v_in = self.to_v(context)
-         del context, x
-
-         b, _, _ = q_in.shape
-         q, k, v = map(
-             lambda t: t.unsqueeze(3)
-             .reshape(b, t.shape[1], self.heads, self.dim_head)
-             .permute(0, 2, 1, 3)
-             .reshape(b * self.heads, t.shape[1], self.dim_head)
-             .contiguous(),
-             (q_in, k_in, v_in),
-         )
-         del q_in, k_in, v_in
-
-         # actually compute the attention, what we cannot get enough of
-         out = xformers.ops.memory_efficient_attention(q,
-                                                       k,
-                                                       v,
-                                                       attn_bias=None,
-                                                       op=self.attention_op)
-         del q, k, v
-
-         # TODO: Use this directly in the attention operation, as a bias
-         if exists(mask):
-             raise NotImplementedError()
-         out2 = (out.unsqueeze(0)
-                 .reshape(b, self.heads, out.shape[1], self.dim_head)
-                 .permute(0, 2, 1, 3)
-                 .reshape(b, out.shape[1], self.heads * self.dim_head))
-         del out
-
-         out3 = self.to_out(out2)
-         del out2
-
-         return out3
+class MemoryEfficientCrossAttention(CrossAttention):
+    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.0):
+        super().__init__(query_dim,
+                         context_dim=context_dim,
+                         heads=heads,
+                         dim_head=dim_head,
+                         dropout=dropout,
+                         backend="xformers")
 
 
 class BasicTransformerBlock(nn.Module):
-    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True):
+    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True,
+                 attn_backend=None):
         super().__init__()
+        # the kernel is looked up in ATTENTION_BACKENDS on every call,
+        # attn_backend None follows ATTENTION_BACKEND
         ctor = CrossAttention
         # is a self-attention
         self.attn1 = ctor(query_dim=dim,
                           heads=n_heads,
                           dim_head=d_head,
-                          dropout=dropout)
+                          dropout=dropout,
+                          backend=attn_backend)
         self.ff = FeedForward(dim, dropout=dropout, glu=gated_ff)
         # is self-attn if context is none
         self.attn2 = ctor(query_dim=dim,
                           context_dim=context_dim,
                           heads=n_heads,
                           dim_head=d_head,
-                          dropout=dropout)
+                          dropout=dropout,
+                          backend=attn_backend)
         self.norm1 = nn.LayerNorm(dim)
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
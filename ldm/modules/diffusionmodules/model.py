@@ -1,6 +1,8 @@
 # pytorch_diffusion + derived encoder decoder
 import gc
 import math
+import threading
+from contextlib import contextmanager
 import torch
 import torch.nn as nn
 from torch.nn.functional import silu
@@ -8,7 +10,7 @@ import numpy as np
 from einops import rearrange
 
 from ldm.util import instantiate_from_config
-from ldm.modules.attention import LinearAttention
+from ldm.modules.attention import LinearAttention, online_softmax_attention
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -167,10 +169,41 @@ class LinAttnBlock(LinearAttention):
         super().__init__(dim=in_channels, heads=1, dim_head=in_channels)
 
 
+def set_attn_chunking(model, query_chunk=None, key_chunk=None):
+    """
+    switches every AttnBlock of model to online_softmax_attention with
+    the given chunk sizes, or back to full attention when query_chunk is None
+    """
+    for module in model.modules():
+        if isinstance(module, AttnBlock):
+            module.query_chunk = query_chunk
+            module.key_chunk = key_chunk
+
+
+_chunking = threading.local()
+
+
+@contextmanager
+def attn_chunking(query_chunk=None, key_chunk=None):
+    """
+    chunk sizes of every AttnBlock run by the current thread in the block,
+    over what set_attn_chunking set on the modules, so models shared between
+    threads aren't modified
+    """
+    previous = getattr(_chunking, "chunks", None)
+    _chunking.chunks = (query_chunk, key_chunk)
+    try:
+        yield
+    finally:
+        _chunking.chunks = previous
+
+
 class AttnBlock(nn.Module):
     def __init__(self, in_channels):
         super().__init__()
         self.in_channels = in_channels
+        self.query_chunk = None
+        self.key_chunk = None
 
         self.norm = Normalize(in_channels)
         self.q = torch.nn.Conv2d(in_channels,
@@ -195,7 +228,14 @@ class AttnBlock(nn.Module):
                                         padding=0)
 
 
+    def chunks(self):
+        scoped = getattr(_chunking, "chunks", None)
+        return (self.query_chunk, self.key_chunk) if scoped is None else scoped
+
     def forward(self, x):
+        query_chunk, key_chunk = self.chunks()
+        if query_chunk is not None:
+            return self.forward_chunked(x, query_chunk, key_chunk)
         h_1 = self.norm(x)
         q1 = self.q(h_1)
         k1 = self.k(h_1)
@@ -232,6 +272,33 @@ class AttnBlock(nn.Module):
 
         return h_4
 
+    def forward_chunked(self, x, query_chunk, key_chunk=None):
+        h_1 = self.norm(x)
+        q1 = self.q(h_1)
+        k1 = self.k(h_1)
+        v1 = self.v(h_1)
+        del h_1
+
+        b, c, h, w = q1.shape
+        q2 = q1.reshape(b, c, h * w).permute(0, 2, 1) # b,hw,c
+        del q1
+        k2 = k1.reshape(b, c, h * w) # b,c,hw
+        del k1
+        v2 = v1.reshape(b, c, h * w).permute(0, 2, 1) # b,hw,c
+        del v1
+        h_2 = online_softmax_attention(q2, k2, v2, int(c)**(-0.5), query_chunk, key_chunk)
+        del q2, k2, v2
+        h_3 = h_2.permute(0, 2, 1).reshape(b, c, h, w)
+        del h_2
+
+        h_4 = self.proj_out(h_3)
+        del h_3
+
+        h_4 += x
+        del x
+
+        return h_4
+
 
 def make_attn(in_channels, attn_type="vanilla"):
     assert attn_type in ["vanilla", "linear", "none"], f'attn_type {attn_type} unknown'
@@ -264,4 +264,20 @@ class HybridConditioner(nn.Module):
 def noise_like(shape, device, repeat=False):
     repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
     noise = lambda: torch.randn(shape, device=device)
-    return repeat_noise() if repeat else noise()
\ No newline at end of file
+    return repeat_noise() if repeat else noise()
+
+def delta_border(h, w):
+    """
+    :param h: height
+    :param w: width
+    :return: normalized distance to image border,
+     with min distance = 0 at border and max dist = 0.5 at image center
+    """
+    y = torch.arange(0, h).view(h, 1, 1).repeat(1, w, 1)
+    x = torch.arange(0, w).view(1, w, 1).repeat(h, 1, 1)
+    lower_right_corner = torch.tensor([h - 1, w - 1]).view(1, 1, 2)
+    arr = torch.cat([y, x], dim=-1) / lower_right_corner
+    dist_left_up = torch.min(arr, dim=-1, keepdims=True)[0]
+    dist_right_down = torch.min(1 - arr, dim=-1, keepdims=True)[0]
+    edge_dist = torch.min(torch.cat([dist_left_up, dist_right_down], dim=-1), dim=-1)[0]
+    return edge_dist
@@ -1,10 +1,8 @@
 import torch
 import torch.nn as nn
 from functools import partial
-import clip
 from einops import rearrange, repeat
 from transformers import CLIPTokenizer, CLIPTextModel
-import kornia
 
 from ldm.modules.x_transformer import Encoder, TransformerWrapper  # TODO: can we directly rely on lucidrains code and simply add this as a reuirement? --> test
 
@@ -140,6 +138,7 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         super().__init__()
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
         self.transformer = CLIPTextModel.from_pretrained(version)
+        self.version = version
         self.device = device
         self.max_length = max_length
         self.freeze()
@@ -149,7 +148,13 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         for param in self.parameters():
             param.requires_grad = False
 
+    def tokenize(self, text):
+        """token ids of every text, without start and end tokens and not truncated"""
+        return self.tokenizer(text, add_special_tokens=False, truncation=False)["input_ids"]
+
     def forward(self, text):
+        if len(text) and not isinstance(text[0], str):
+            return self.encode_tokens(text)
         batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True,
                                         return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
         tokens = batch_encoding["input_ids"].to(self.device)
@@ -158,6 +163,46 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         z = outputs.last_hidden_state
         return z
 
+    def windows(self, ids):
+        """number of max_length token windows the token ids need"""
+        n = self.max_length - 2
+        return max(1, -(-len(ids) // n))
+
+    def encode_tokens(self, sequences):
+        """
+        hidden states of (token ids, token weights, windows) as returned by
+        tokenize with a weight per token. The ids are split into windows of
+        max_length - 2 tokens, each with its own start and end token, and all
+        windows of all sequences run through the transformer in one batch.
+        The hidden states of the windows of a sequence are concatenated, so
+        a sequence of k windows gives k * max_length of them. The hidden
+        state of every token is scaled by its weight, then all of them are
+        rescaled to the mean they had unweighted.
+        """
+        n = self.max_length - 2
+        bos, eos, pad = self.tokenizer.bos_token_id, self.tokenizer.eos_token_id, self.tokenizer.pad_token_id
+        count = sum(windows for _, _, windows in sequences)
+        tokens = torch.full((count, self.max_length), pad, dtype=torch.long)
+        weights = torch.ones(count, self.max_length)
+        row = 0
+        for ids, token_weights, windows in sequences:
+            for i in range(0, windows * n, n):
+                window, window_weights = list(ids[i:i + n]), list(token_weights[i:i + n])
+                tokens[row, :len(window) + 2] = torch.tensor([bos] + window + [eos])
+                weights[row, 1:len(window) + 1] = torch.tensor(window_weights)
+                row += 1
+        z = self.transformer(input_ids=tokens.to(self.device)).last_hidden_state
+
+        # windows of a sequence next to each other along the sequence axis
+        splits = [windows for _, _, windows in sequences]
+        z = torch.stack([chunk.reshape(-1, z.shape[-1]) for chunk in z.split(splits)])
+        weights = torch.stack([chunk.reshape(-1) for chunk in weights.split(splits)]).to(z.device, z.dtype)
+        if (weights != 1).any():
+            mean = z.mean(dim=(1, 2), keepdim=True)
+            z = z * weights[:, :, None]
+            z = z * (mean / z.mean(dim=(1, 2), keepdim=True))
+        return z
+
     def encode(self, text):
         return self(text)
 
@@ -168,6 +213,8 @@ class FrozenCLIPTextEmbedder(nn.Module):
     """
     def __init__(self, version='ViT-L/14', device="cuda", max_length=77, n_repeat=1, normalize=True):
         super().__init__()
+        # clip is only needed by this embedder, so only import it here
+        import clip
         self.model, _ = clip.load(version, jit=False, device="cpu")
         self.device = device
         self.max_length = max_length
@@ -180,6 +227,7 @@ class FrozenCLIPTextEmbedder(nn.Module):
             param.requires_grad = False
 
     def forward(self, text):
+        import clip
         tokens = clip.tokenize(text).to(self.device)
         z = self.model.encode_text(tokens)
         if self.normalize:
@@ -206,6 +254,7 @@ class FrozenClipImageEmbedder(nn.Module):
             antialias=False,
         ):
         super().__init__()
+        import clip
         self.model, _ = clip.load(name=model, device=device, jit=jit)
 
         self.antialias = antialias
@@ -214,6 +263,7 @@ class FrozenClipImageEmbedder(nn.Module):
         self.register_buffer('std', torch.Tensor([0.26862954, 0.26130258, 0.27577711]), persistent=False)
 
     def preprocess(self, x):
+        import kornia
         # normalize to [0,1]
         x = kornia.geometry.resize(x, (224, 224),
                                    interpolation='bicubic',align_corners=True,
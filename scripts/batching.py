@@ -0,0 +1,146 @@
+import threading
+import time
+import torch
+
+
+class _Request:
+    def __init__(self, x, t, cond):
+        self.x = x
+        self.t = t
+        self.cond = cond
+        self.rows = x.shape[0]
+        self.arrival = time.monotonic()
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class BatchScheduler:
+    """
+    Collects denoising steps of concurrently running jobs and runs them
+    through the UNet as one batch.
+
+    Jobs call apply_model() instead of UNet.apply_model(). Pending steps
+    are grouped by latent and conditioning shape, so only jobs sharing
+    resolution end up in the same batch. A group is flushed when it holds
+    max_batch rows, when its oldest step waited max_wait seconds or when
+    every active job has a step pending. The thread whose step
+    heads the group runs the batch and scatters the results back.
+    on_idle is called once the last active job has ended, before another
+    job can start, e.g. to give back memory the model held for the jobs.
+    """
+    def __init__(self, apply_fn, max_batch=8, max_wait=0.01, on_idle=None):
+        self.apply_fn = apply_fn
+        self.on_idle = on_idle
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cv = threading.Condition()
+        self.run_lock = threading.Lock()
+        self.groups = {}
+        self.leaders = set()
+        self.active_jobs = 0
+        self.waiting = 0
+
+    def job(self):
+        """context manager registering a job which will call apply_model"""
+        return _JobScope(self)
+
+    def _key(self, x, cond):
+        return (tuple(x.shape[1:]), tuple(cond.shape[1:]), x.dtype, cond.dtype, x.device)
+
+    def _should_flush(self, group):
+        rows = sum(r.rows for r in group)
+        if rows >= self.max_batch:
+            return True
+        if self.waiting >= self.active_jobs:
+            return True
+        return time.monotonic() - group[0].arrival >= self.max_wait
+
+    def _take(self, group):
+        batch, rows = [], 0
+        while group and (not batch or rows + group[0].rows <= self.max_batch):
+            request = group.pop(0)
+            batch.append(request)
+            rows += request.rows
+        return batch
+
+    def _run(self, batch):
+        try:
+            if len(batch) == 1:
+                r = batch[0]
+                outs = [self.apply_fn(r.x, r.t, r.cond)]
+            else:
+                x = torch.cat([r.x for r in batch])
+                t = torch.cat([r.t for r in batch])
+                cond = torch.cat([r.cond for r in batch])
+                out = self.apply_fn(x, t, cond)
+                del x, t, cond
+                outs = torch.split(out, [r.rows for r in batch])
+            for r, out in zip(batch, outs):
+                r.result = out
+        except Exception as e:
+            for r in batch:
+                r.error = e
+
+    def apply_model(self, x, t, cond):
+        request = _Request(x, t, cond)
+        key = self._key(x, cond)
+        with self.cv:
+            group = self.groups.setdefault(key, [])
+            group.append(request)
+            self.waiting += 1
+            self.cv.notify_all()
+            while not request.done:
+                group = self.groups.get(key)
+                if key in self.leaders or not group or group[0] is not request:
+                    self.cv.wait()
+                    continue
+                if not self._should_flush(group):
+                    timeout = self.max_wait - (time.monotonic() - group[0].arrival)
+                    self.cv.wait(max(timeout, 0))
+                    continue
+
+                # this thread leads the group: take a batch and run it
+                self.leaders.add(key)
+                batch = self._take(group)
+                self.waiting -= len(batch)
+                if not group:
+                    del self.groups[key]
+                self.cv.release()
+                try:
+                    with self.run_lock:
+                        self._run(batch)
+                finally:
+                    self.cv.acquire()
+                    self.leaders.discard(key)
+                    for r in batch:
+                        r.done = True
+                        r.x = r.t = r.cond = None
+                    # steps held back by the running batch get a fresh
+                    # chance to merge with the jobs coming back from it
+                    now = time.monotonic()
+                    for r in self.groups.get(key, []):
+                        r.arrival = now
+                    self.cv.notify_all()
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+
+class _JobScope:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def __enter__(self):
+        with self.scheduler.cv:
+            self.scheduler.active_jobs += 1
+        return self.scheduler
+
+    def __exit__(self, *exc):
+        with self.scheduler.cv:
+            self.scheduler.active_jobs -= 1
+            if self.scheduler.active_jobs == 0 and self.scheduler.on_idle is not None:
+                self.scheduler.on_idle()
+            self.scheduler.cv.notify_all()
+        return False
@@ -0,0 +1,185 @@
+"""
+Attention microbenchmarks.
+
+--target vae compares full attention of the autoencoder AttnBlock against
+the chunked online softmax one at growing latent sizes. Every case runs
+in a fresh process so peak memory (growth of max RSS on CPU, max
+allocated memory on CUDA) isn't carried over between cases.
+
+--target unet times every UNet attention backend on the self and cross
+attention shapes of an image size and shows what the autotuner picks.
+
+python scripts/bench_attention.py --sizes 32 64 96 --query_chunk 1024
+python scripts/bench_attention.py --target unet --sizes 64
+"""
+import argparse, multiprocessing, sys, time
+import torch
+from ldm.modules.diffusionmodules.model import AttnBlock, set_attn_chunking
+from ldm.modules import attention
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is only reported on CUDA there
+    resource = None
+
+
+def max_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_case(size, channels, query_chunk, key_chunk, device, repeats):
+    torch.manual_seed(0)
+    block = AttnBlock(channels).to(device).eval()
+    set_attn_chunking(block, query_chunk, key_chunk)
+    x = torch.randn(1, channels, size, size, device=device)
+
+    with torch.no_grad():
+        if device == "cpu":
+            base = max_rss()
+        else:
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+        out = block(x)
+        if device == "cpu":
+            peak = max_rss() - base if base is not None else None
+        else:
+            torch.cuda.synchronize(device)
+            peak = torch.cuda.max_memory_allocated(device) - base
+
+        tic = time.perf_counter()
+        for _ in range(repeats):
+            block(x)
+        if device != "cpu":
+            torch.cuda.synchronize(device)
+        ms = (time.perf_counter() - tic) / repeats * 1000
+
+    return ms, peak, out.cpu()
+
+
+def run_isolated(ctx, *args):
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_case, args)
+
+
+def unet_shapes(size, context=77):
+    """(name, n, m, heads, head dim) of the SD v1 UNet attentions at a latent size"""
+    shapes = []
+    for level, dim_head in enumerate((40, 80, 160, 160)):
+        n = (size >> level) ** 2
+        shapes.append((f"self {size >> level}", n, n, 8, dim_head))
+        shapes.append((f"cross {size >> level}", n, context, 8, dim_head))
+    return shapes
+
+
+def bench_unet(opt):
+    dtype = torch.float16 if opt.half else torch.float32
+    attention.QUERY_CHUNK = opt.query_chunk
+    tuner = attention.AttentionAutotuner(repeats=opt.repeats)
+    names = list(attention.ATTENTION_BACKENDS)
+    print(f"{'shape':>10} " + " ".join(f"{name:>9}" for name in names) + f" {'auto':>9}")
+    for size in opt.sizes:
+        for label, n, m, heads, dim_head in unet_shapes(size, opt.context):
+            torch.manual_seed(0)
+            q = torch.randn(heads, n, dim_head, device=opt.device, dtype=dtype)
+            k = torch.randn(heads, m, dim_head, device=opt.device, dtype=dtype)
+            v = torch.randn(heads, m, dim_head, device=opt.device, dtype=dtype)
+            scale = dim_head ** -0.5
+            cells = []
+            for name in names:
+                backend = attention.ATTENTION_BACKENDS[name]
+                if not backend.available(q):
+                    cells.append(f"{'-':>9}")
+                    continue
+                ms = tuner.measure(backend.fn, q, k, v, scale) * 1000
+                cells.append(f"{ms:9.2f}")
+            choice = tuner.select(q, k, v, scale)
+            print(f"{label:>10} " + " ".join(cells) + f" {choice:>9}")
+            del q, k, v
+    print("times in ms, - marks backends not available here")
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--target",
+    type=str,
+    choices=["vae", "unet"],
+    default="vae",
+    help="benchmark the autoencoder AttnBlock or the UNet attention backends",
+)
+parser.add_argument(
+    "--context",
+    type=int,
+    default=77,
+    help="--target unet: tokens of the cross attention context, 77 per window of the prompt",
+)
+parser.add_argument(
+    "--sizes",
+    type=int,
+    nargs="+",
+    default=[16, 32, 48, 64],
+    help="latent sizes the attention runs at (64 is a 512x512 image)",
+)
+parser.add_argument(
+    "--channels",
+    type=int,
+    default=512,
+    help="channels of the attention block",
+)
+parser.add_argument(
+    "--query_chunk",
+    type=int,
+    default=1024,
+    help="queries per chunk of the chunked attention",
+)
+parser.add_argument(
+    "--half",
+    action="store_true",
+    help="run the unet target in half precision (GPU only)",
+)
+parser.add_argument(
+    "--key_chunk",
+    type=int,
+    default=None,
+    help="keys per chunk of the chunked attention (default: all keys at once)",
+)
+parser.add_argument(
+    "--device",
+    type=str,
+    default="cpu",
+    help="device to benchmark on",
+)
+parser.add_argument(
+    "--repeats",
+    type=int,
+    default=3,
+    help="timed runs per case",
+)
+
+
+def main():
+    opt = parser.parse_args()
+    if opt.target == "unet":
+        bench_unet(opt)
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+    mb = lambda n: f"{n / 2**20:10.1f}" if n is not None else "       n/a"
+
+    print(f"{'size':>6} {'mode':>8} {'ms':>10} {'peak MB':>10} {'max diff':>10}")
+    for size in opt.sizes:
+        full_ms, full_peak, full_out = run_isolated(ctx, size, opt.channels, None, None,
+                                                    opt.device, opt.repeats)
+        ms, peak, out = run_isolated(ctx, size, opt.channels, opt.query_chunk, opt.key_chunk,
+                                     opt.device, opt.repeats)
+        diff = (out - full_out).abs().max().item()
+        print(f"{size:>6} {'full':>8} {full_ms:10.1f} {mb(full_peak)} {'':>10}")
+        print(f"{size:>6} {'chunked':>8} {ms:10.1f} {mb(peak)} {diff:10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Sampler quality against the number of UNet evaluations (NFE).
+
+A small UNet with random weights stands in for the real model, so this
+runs in seconds on CPU without a checkpoint. Every sampler denoises the
+same noise with the same guidance, and its result is compared with a
+reference solution of many small steps. The error is the RMS difference
+to the reference relative to the reference's RMS.
+
+python scripts/bench_samplers.py --nfe 10 15 20 30 50
+"""
+import argparse, time
+import torch
+import torch.nn as nn
+from ldm.modules.diffusionmodules.openaimodel import UNetModel
+from ldm.modules.diffusionmodules.util import make_beta_schedule
+from samplers import SAMPLERS, run_sampler
+
+
+# samplers calling the model twice per step
+SECOND_ORDER = ("heun", "dpm2", "dpm2_a")
+
+
+class TinyUNet(nn.Module):
+    """randomly initialized UNet behind the apply_model interface of the CompVis model"""
+    def __init__(self, channels, context_dim):
+        super().__init__()
+        self.unet = UNetModel(image_size=32,
+                              in_channels=4,
+                              out_channels=4,
+                              model_channels=channels,
+                              attention_resolutions=[2],
+                              num_res_blocks=1,
+                              channel_mult=(1, 2),
+                              num_heads=4,
+                              use_spatial_transformer=True,
+                              context_dim=context_dim,
+                              legacy=False)
+        # zero initialized output layers would make every prediction zero
+        for param in self.unet.parameters():
+            if not param.any():
+                nn.init.normal_(param, std=0.02)
+        self.nfe = 0
+
+    def apply_model(self, x, t, cond):
+        self.nfe += 1
+        return self.unet(x, t, context=cond)
+
+
+def alphas_cumprod():
+    # same schedule as the v1 checkpoints
+    betas = make_beta_schedule("linear", 1000, linear_start=0.00085, linear_end=0.0120)
+    return torch.cumprod(1. - torch.from_numpy(betas), dim=0).float()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--samplers",
+    type=str,
+    nargs="+",
+    choices=list(SAMPLERS),
+    default=[name for name in SAMPLERS if not name.endswith("_a")],
+    help="samplers to compare, ancestral ones don't converge to the reference",
+)
+parser.add_argument(
+    "--nfe",
+    type=int,
+    nargs="+",
+    default=[10, 15, 20, 30, 50],
+    help="UNet evaluation budgets",
+)
+parser.add_argument(
+    "--reference",
+    type=str,
+    choices=list(SAMPLERS),
+    default="heun",
+    help="sampler of the reference solution",
+)
+parser.add_argument(
+    "--reference_steps",
+    type=int,
+    default=500,
+    help="steps of the reference solution",
+)
+parser.add_argument(
+    "--schedule",
+    type=str,
+    choices=["linear", "karras", "exponential"],
+    default="linear",
+    help="noise levels of the compared samplers, the reference always uses linear",
+)
+parser.add_argument(
+    "--size",
+    type=int,
+    default=16,
+    help="latent size",
+)
+parser.add_argument(
+    "--channels",
+    type=int,
+    default=32,
+    help="base channels of the UNet",
+)
+parser.add_argument(
+    "--scale",
+    type=float,
+    default=7.5,
+    help="unconditional guidance scale",
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=42,
+)
+parser.add_argument(
+    "--device",
+    type=str,
+    default="cpu",
+    help="device to benchmark on",
+)
+
+
+def main():
+    opt = parser.parse_args()
+    torch.manual_seed(opt.seed)
+    context_dim = 64
+    model = TinyUNet(opt.channels, context_dim).to(opt.device).eval()
+    ac = alphas_cumprod().to(opt.device)
+    x = torch.randn(1, 4, opt.size, opt.size, device=opt.device)
+    cond = torch.randn(1, 8, context_dim, device=opt.device)
+    uncond = torch.randn(1, 8, context_dim, device=opt.device)
+
+    def sample(name, steps, schedule):
+        model.nfe = 0
+        out = run_sampler(name, model, ac, x, steps, cond, uncond, opt.scale, disable=True, schedule=schedule)
+        return out, model.nfe
+
+    reference, _ = sample(opt.reference, opt.reference_steps, "linear")
+    norm = reference.pow(2).mean().sqrt()
+
+    print(f"{'sampler':>10} " + " ".join(f"{'nfe ' + str(nfe):>14}" for nfe in opt.nfe) + f" {'s/nfe':>8}")
+    for name in opt.samplers:
+        cells = []
+        tic, total = time.perf_counter(), 0
+        for nfe in opt.nfe:
+            steps = nfe // 2 if name in SECOND_ORDER else nfe
+            out, used = sample(name, max(steps, 2), opt.schedule)
+            total += used
+            error = ((out - reference).pow(2).mean().sqrt() / norm).item()
+            cells.append(f"{error:9.2e} ({used:>2})")
+        seconds = (time.perf_counter() - tic) / total
+        print(f"{name:>10} " + " ".join(cells) + f" {seconds:8.3f}")
+    print("relative RMS error to the reference, evaluations used in brackets")
+
+
+if __name__ == "__main__":
+    main()
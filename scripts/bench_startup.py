@@ -0,0 +1,82 @@
+"""
+Startup time of the scripts and the imports it goes to.
+
+Runs a script in a fresh interpreter under `python -X importtime` and
+reports the wall time of the run and the modules taking the longest to
+import. With the default `--help` this is the time until the scripts
+can answer without loading anything.
+
+python scripts/bench_startup.py scripts/txt2img.py
+python scripts/bench_startup.py scripts/txt2img.py --args --prompt "a cat" --ckpt missing.ckpt
+"""
+import argparse, os, subprocess, sys, time
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "script",
+    type=str,
+    help="script to start",
+)
+parser.add_argument(
+    "--args",
+    nargs=argparse.REMAINDER,
+    default=["--help"],
+    help="arguments of the script, everything after --args is passed on",
+)
+parser.add_argument(
+    "--repeat",
+    type=int,
+    default=3,
+    help="number of runs, the fastest one is reported",
+)
+parser.add_argument(
+    "--top",
+    type=int,
+    default=15,
+    help="number of imports listed",
+)
+
+
+def parse_importtime(stderr):
+    """(self us, cumulative us, depth, module) of every import in -X importtime output"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((int(own), int(cumulative), depth, name.strip()))
+    return imports
+
+
+def run(script, args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(script), ".", os.environ.get("PYTHONPATH")])))
+    tic = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", script, *args],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, env=env)
+    return time.perf_counter() - tic, result.returncode, parse_importtime(result.stderr)
+
+
+def main():
+    opt = parser.parse_args()
+    runs = [run(opt.script, opt.args) for _ in range(max(opt.repeat, 1))]
+    seconds, returncode, imports = min(runs, key=lambda r: r[0])
+
+    top_level = [i for i in imports if i[2] == 0]
+    total = sum(cumulative for _, cumulative, _, _ in top_level)
+    print(f"{opt.script} {' '.join(opt.args)}")
+    print(f"wall time {seconds:.3f} s (best of {len(runs)}), exit code {returncode}, "
+          f"{len(imports)} modules imported in {total / 1e6:.3f} s")
+
+    print(f"\n{'cumulative':>12} {'self':>10}  top-level import")
+    for own, cumulative, _, name in sorted(top_level, key=lambda i: -i[1])[:opt.top]:
+        print(f"{cumulative / 1e3:10.1f}ms {own / 1e3:8.1f}ms  {name}")
+
+    print(f"\n{'self':>12}  module")
+    for own, _, _, name in sorted(imports, key=lambda i: -i[0])[:opt.top]:
+        print(f"{own / 1e3:10.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import threading
+import time
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """
+    cooperative cancellation of a job. Any thread may cancel it, and with
+    a timeout it cancels itself once that many seconds have passed. The
+    sampling loops check it between steps and stop with Cancelled.
+    """
+    def __init__(self, timeout=None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="job was cancelled"):
+        if not self.event.is_set():
+            self.reason = reason
+            self.event.set()
+
+    def cancelled(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("job ran past its deadline")
+        return self.event.is_set()
+
+    def check(self):
+        if self.cancelled():
+            raise Cancelled(self.reason)
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+class ConditioningCache:
+    """
+    Content addressed LRU cache of text conditionings.
+
+    Entries are keyed on the token ids of a prompt together with the
+    encoder version and dtype, so every unique prompt runs through the
+    text encoder only once. The in-memory part is bounded by max_bytes,
+    when cache_dir is given entries are also persisted there as .npy
+    files and survive restarts.
+    """
+    def __init__(self, max_bytes=64 * 2**20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, encoder, text):
+        tokenizer = getattr(encoder, "tokenizer", None)
+        if not isinstance(text, str):
+            # (token ids, token weights, windows) of a compiled prompt
+            content = repr(tuple(text))
+        elif tokenizer is not None:
+            ids = tokenizer(text,
+                            truncation=True,
+                            max_length=getattr(encoder, "max_length", 77))["input_ids"]
+            content = ",".join(map(str, ids))
+        else:
+            content = text
+        dtype = next(encoder.parameters()).dtype
+        autocast = torch.is_autocast_enabled()
+        version = getattr(encoder, "version", type(encoder).__name__)
+        raw = f"{version}|{dtype}|{autocast}|{content}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def _get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            value = torch.from_numpy(np.load(self._path(key), allow_pickle=False))
+            self._put(key, value, persist=False)
+            return value
+        return None
+
+    def _put(self, key, value, persist=True):
+        if persist and self.cache_dir is not None:
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, value.numpy(), allow_pickle=False)
+            os.replace(tmp_path, path)
+        nbytes = value.element_size() * value.nelement()
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.size += nbytes
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.size -= old.element_size() * old.nelement()
+
+    def lookup(self, encoder, texts, encode_fn):
+        """
+        returns conditionings of texts, running encode_fn once on the
+        unique texts not cached yet
+        """
+        keys = [self.key(encoder, text) for text in texts]
+        found = {}
+        missing = []
+        for text, key in zip(texts, keys):
+            if key in found:
+                continue
+            value = self._get(key)
+            if value is None:
+                if key not in missing:
+                    missing.append(key)
+                    found[key] = text
+                continue
+            found[key] = value
+
+        if missing:
+            self.misses += len(missing)
+            encoded = encode_fn([found[key] for key in missing])
+            device = encoded.device
+            for i, key in enumerate(missing):
+                value = encoded[i].detach().to("cpu").clone()
+                self._put(key, value)
+                found[key] = value
+        else:
+            device = getattr(encoder, "device", "cpu")
+        self.hits += len(texts) - len(missing)
+
+        return torch.stack([found[key] for key in keys]).to(device)
@@ -0,0 +1,72 @@
+"""
+Converts a pickled checkpoint into the pickle free tensor file format read
+by tensorfile.TensorFile.
+
+UNet keys are renamed into the model1./model2. halves used by the split
+UNet, EMA weights are dropped and tensors are grouped per sub-model so
+loading one sub-model reads one contiguous part of the file.
+"""
+import argparse, os
+import torch
+from pipeline import load_model_from_config, split_unet_state_dict
+from tensorfile import save_file
+
+
+# sub-model groups, in the order they are written
+GROUPS = ("model1.", "model2.", "cond_stage_model.", "first_stage_model.")
+
+
+def group_index(key):
+    for i, prefix in enumerate(GROUPS):
+        if key.startswith(prefix):
+            return i
+    return len(GROUPS)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--ckpt",
+    type=str,
+    required=True,
+    help="path to pickled checkpoint of model",
+)
+parser.add_argument(
+    "--out",
+    type=str,
+    default=None,
+    help="path of converted checkpoint (default: ckpt with .safetensors extension)",
+)
+parser.add_argument(
+    "--half",
+    action="store_true",
+    help="store floating point tensors in half precision",
+)
+parser.add_argument(
+    "--keep-ema",
+    action="store_true",
+    help="keep EMA weights, they are not used for sampling",
+)
+
+
+def main():
+    opt = parser.parse_args()
+    out = opt.out or os.path.splitext(opt.ckpt)[0] + ".safetensors"
+
+    sd = split_unet_state_dict(load_model_from_config(opt.ckpt))
+    tensors = {}
+    for key in sorted(sd, key=lambda k: (group_index(k), k)):
+        value = sd[key]
+        if not isinstance(value, torch.Tensor):
+            continue
+        if key.startswith("model_ema.") and not opt.keep_ema:
+            continue
+        if opt.half and value.is_floating_point():
+            value = value.half()
+        tensors[key] = value
+
+    save_file(tensors, out, metadata={"format": "pt", "groups": ",".join(GROUPS)})
+    print(f"Wrote {len(tensors)} tensors to {out}")
+
+
+if __name__ == "__main__":
+    main()
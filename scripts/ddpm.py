@@ -7,12 +7,13 @@ https://github.com/CompVis/taming-transformers
 """
 
 import time, math
-from tqdm.auto import trange, tqdm
+from contextlib import nullcontext
 import torch
 from einops import rearrange
 from tqdm import tqdm
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 from ldm.models.autoencoder import VQModelInterface
+from ldm.modules.attention import kv_cache_session, cfg_conditioning
 import torch.nn as nn
 import numpy as np
 import pytorch_lightning as pl
@@ -21,8 +22,10 @@ from pytorch_lightning.utilities.distributed import rank_zero_only
 from ldm.util import exists, default, instantiate_from_config
 from ldm.modules.diffusionmodules.util import make_beta_schedule
 from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
-from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
-from samplers import CompVisDenoiser, get_ancestral_step, to_d, append_dims,linear_multistep_coeff
+from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like, delta_border
+from samplers import SAMPLERS, BatchNoise, run_sampler
+from offload import OffloadEngine, module_bytes
+
 
 def disabled_train(self):
     """Overwrite model.train with this function to make sure train/eval mode
@@ -141,6 +144,13 @@ class FirstStage(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None
+        self.tile_params = {
+            "clip_min_weight": 0.01,
+            "clip_max_weight": 0.5,
+            "min_tile": 16,
+            # rough peak of decoder activations per latent pixel and batch item
+            "bytes_per_latent_pixel": 32768,
+        }
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -187,6 +197,63 @@ class FirstStage(DDPM):
             else:
                 return self.first_stage_model.decode(z)
 
+    def get_weighting(self, h, w, device, dtype):
+        """blending weights of a decoded tile, highest in its center"""
+        weighting = delta_border(h, w)
+        weighting = torch.clip(weighting, self.tile_params["clip_min_weight"],
+                               self.tile_params["clip_max_weight"], )
+        return weighting.view(1, 1, h, w).to(device=device, dtype=dtype)
+
+    def tile_size(self, z, budget):
+        """
+        largest side of a square latent tile whose decode is estimated to
+        fit into budget bytes
+        """
+        b, _, h, w = z.shape
+        per_pixel = self.tile_params["bytes_per_latent_pixel"]
+        estimate = lambda t: z.element_size() * b * (per_pixel * t * t + 2 * t ** 4)
+        t = max(h, w)
+        while t > self.tile_params["min_tile"] and estimate(t) > budget:
+            t -= 8
+        # stepping by 8 from a size which isn't a multiple of it overshoots
+        return max(t, min(self.tile_params["min_tile"], max(h, w)))
+
+    def tile_starts(self, size, tile, overlap):
+        if size <= tile:
+            return [0]
+        n = math.ceil((size - overlap) / (tile - overlap))
+        return [round(i * (size - tile) / (n - 1)) for i in range(n)]
+
+    @torch.no_grad()
+    def decode_first_stage_tiled(self, z, budget, overlap=8):
+        """
+        decodes z in overlapping latent tiles sized from a memory budget in
+        bytes, tiles are blended with get_weighting so there are no seams
+        """
+        z = 1. / self.scale_factor * z
+        b, _, h, w = z.shape
+        uf = 2 ** self.num_downs
+        tile = self.tile_size(z, budget)
+        th, tw = min(tile, h), min(tile, w)
+        # the blend needs tiles which overlap
+        overlap = min(overlap, tile // 2)
+
+        out = None
+        for y in self.tile_starts(h, tile, overlap):
+            for x in self.tile_starts(w, tile, overlap):
+                dec = self.first_stage_model.decode(z[:, :, y:y + th, x:x + tw])
+                if out is None:
+                    out = torch.zeros((b, dec.shape[1], h * uf, w * uf), device=dec.device, dtype=dec.dtype)
+                    norm = torch.zeros((1, 1, h * uf, w * uf), device=dec.device, dtype=dec.dtype)
+                    weighting = self.get_weighting(th * uf, tw * uf, dec.device, dec.dtype)
+                out[:, :, y * uf:(y + th) * uf, x * uf:(x + tw) * uf] += dec * weighting
+                norm[:, :, y * uf:(y + th) * uf, x * uf:(x + tw) * uf] += weighting
+                del dec
+
+        out /= norm
+        del norm, weighting
+        return out
+
 
     @torch.no_grad()
     def encode_first_stage(self, x):
@@ -263,6 +330,7 @@ class CondStage(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None
+        self.cond_cache = None
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -291,6 +359,11 @@ class CondStage(DDPM):
             self.cond_stage_model = model
 
     def get_learned_conditioning(self, c):
+        if self.cond_cache is not None and isinstance(c, list):
+            return self.cond_cache.lookup(self.cond_stage_model, c, self.encode_conditioning)
+        return self.encode_conditioning(c)
+
+    def encode_conditioning(self, c):
         if self.cond_stage_forward is None:
             if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
                 c = self.cond_stage_model.encode(c)
@@ -365,6 +438,11 @@ class UNet(DDPM):
         self.model2.eval()
         self.turbo = False
         self.unet_bs = unet_bs
+        self.batcher = None
+        self.offload = None
+        self.offload_budget = None
+        self.offload_policy = "lookahead"
+        self.residency = None
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys)
@@ -394,9 +472,37 @@ class UNet(DDPM):
 
 
     def apply_model(self, x_noisy, t, cond, return_ids=False):
-
-        if(not self.turbo):
-            self.model1.to(self.cdevice)
+        if self.batcher is not None:
+            return self.batcher.apply_model(x_noisy, t, cond)
+        return self._apply_model(x_noisy, t, cond, return_ids)
+
+    def offload_engine(self):
+        """packs the UNet blocks into pinned host memory on first use"""
+        if self.offload is None:
+            encode = self.model1.diffusion_model
+            decode = self.model2.diffusion_model
+            blocks = [encode.time_embed, *encode.input_blocks, encode.middle_block,
+                      *decode.output_blocks, decode.out]
+            budget = self.offload_budget
+            if budget is None:
+                # same VRAM as the old low VRAM mode, one UNet half at a time
+                budget = max(module_bytes(self.model1), module_bytes(self.model2))
+            self.offload = OffloadEngine(blocks,
+                                         self.cdevice,
+                                         budget=budget,
+                                         policy=self.offload_policy).attach()
+        return self.offload
+
+    def free_offload(self):
+        """gives back the device memory of the blocks paged in by the offload engine"""
+        if self.offload is not None:
+            self.offload.free()
+
+    def _apply_model(self, x_noisy, t, cond, return_ids=False):
+
+        if(not self.turbo and self.cdevice != "cpu"):
+            # blocks are paged in by hooks as they run
+            self.offload_engine()
 
         step = self.unet_bs
         h, emb, hs = self.model1(x_noisy[0:step], t[:step], cond[:step])
@@ -415,10 +521,6 @@ class UNet(DDPM):
                 hs[j] = torch.cat((hs[j], hs_temp[j]))
             del h_temp, emb_temp, hs_temp
 
-        if(not self.turbo):
-            self.model1.to("cpu")
-            self.model2.to(self.cdevice)
-
         hs_temp = [hs[j][:step] for j in range(lenhs)]
         x_recon = self.model2(h[:step],emb[:step],x_noisy.dtype,hs_temp,cond[:step])
 
@@ -428,9 +530,6 @@ class UNet(DDPM):
             x_recon1 = self.model2(h[i:i+step],emb[i:i+step],x_noisy.dtype,hs_temp,cond[i:i+step])
             x_recon = torch.cat((x_recon, x_recon1))
 
-        if(not self.turbo):
-            self.model2.to("cpu")
-
         if isinstance(x_recon, tuple) and not return_ids:
             return x_recon[0]
         else:
@@ -478,6 +577,7 @@ class UNet(DDPM):
                eta=0.,
                mask=None,
                sampler = "plms",
+               schedule = "linear",
                temperature=1.,
                noise_dropout=0.,
                score_corrector=None,
@@ -487,79 +587,85 @@ class UNet(DDPM):
                log_every_t=100,
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
+               noise_sampler=None,
+               cancel=None,
                ):
 
 
-        if(self.turbo):
-            self.model1.to(self.cdevice)
-            self.model2.to(self.cdevice)
-
-        if x0 is None:
-            batch_size, b1, b2, b3 = shape
-            img_shape = (1, b1, b2, b3)
-            tens = []
-            print("seeds used = ", [seed+s for s in range(batch_size)])
-            for _ in range(batch_size):
-                torch.manual_seed(seed)
-                tens.append(torch.randn(img_shape, device=self.cdevice))
-                seed+=1
-            noise = torch.cat(tens)
-            del tens
-
-        x_latent = noise if x0 is None else x0
-        # sampling
-
-        if sampler == "plms":
-            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
-            print(f'Data shape for PLMS sampling is {shape}')
-            samples = self.plms_sampling(conditioning, batch_size, x_latent,
-                                        callback=callback,
-                                        img_callback=img_callback,
-                                        quantize_denoised=quantize_x0,
-                                        mask=mask, x0=x0,
-                                        ddim_use_original_steps=False,
-                                        noise_dropout=noise_dropout,
-                                        temperature=temperature,
-                                        score_corrector=score_corrector,
-                                        corrector_kwargs=corrector_kwargs,
-                                        log_every_t=log_every_t,
-                                        unconditional_guidance_scale=unconditional_guidance_scale,
-                                        unconditional_conditioning=unconditional_conditioning,
-                                        )
-
-        elif sampler == "ddim":
-            samples = self.ddim_sampling(x_latent, conditioning, S, unconditional_guidance_scale=unconditional_guidance_scale,
-                                         unconditional_conditioning=unconditional_conditioning,
-                                         mask = mask,init_latent=x_T,use_original_steps=False)
-
-        elif sampler == "euler":
-            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
-            samples = self.euler_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-        elif sampler == "euler_a":
-            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
-            samples = self.euler_ancestral_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-
-        elif sampler == "dpm2":
-            samples = self.dpm_2_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-        elif sampler == "heun":
-            samples = self.heun_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-
-        elif sampler == "dpm2_a":
-            samples = self.dpm_2_ancestral_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-
-
-        elif sampler == "lms":
-            samples = self.lms_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-
-        if(self.turbo):
-            self.model1.to("cpu")
-            self.model2.to("cpu")
+        # with a batcher the UNet is shared by concurrent jobs and stays put
+        if(self.turbo and self.batcher is None):
+            if self.residency is not None:
+                self.residency.acquire("unet")
+            else:
+                self.model1.to(self.cdevice)
+                self.model2.to(self.cdevice)
+
+        # a cancelled run still gives the UNet back
+        try:
+            batch_size = shape[0] if x0 is None else x0.shape[0]
+            if noise_sampler is None:
+                noise_sampler = BatchNoise(seed, batch_size, self.cdevice)
+            if x0 is None:
+                print("seeds used = ", noise_sampler.seeds)
+                noise = noise_sampler.randn(shape[1:])
+
+            x_latent = noise if x0 is None else x0
+            # sampling
+
+            # cross attention keys and values of the conditioning are computed
+            # once for the whole run. A batcher concatenates the conditionings
+            # of its jobs anew every step, nothing could ever be found again.
+            session = kv_cache_session() if self.batcher is None else nullcontext()
+            with session:
+                if sampler == "plms":
+                    self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
+                    print(f'Data shape for PLMS sampling is {shape}')
+                    samples = self.plms_sampling(conditioning, batch_size, x_latent,
+                                                callback=callback,
+                                                img_callback=img_callback,
+                                                quantize_denoised=quantize_x0,
+                                                mask=mask, x0=x0,
+                                                ddim_use_original_steps=False,
+                                                noise_dropout=noise_dropout,
+                                                temperature=temperature,
+                                                score_corrector=score_corrector,
+                                                corrector_kwargs=corrector_kwargs,
+                                                log_every_t=log_every_t,
+                                                unconditional_guidance_scale=unconditional_guidance_scale,
+                                                unconditional_conditioning=unconditional_conditioning,
+                                                noise_sampler=noise_sampler,
+                                                cancel=cancel,
+                                                )
+
+                elif sampler == "ddim":
+                    samples = self.ddim_sampling(x_latent, conditioning, S, unconditional_guidance_scale=unconditional_guidance_scale,
+                                                 unconditional_conditioning=unconditional_conditioning,
+                                                 mask = mask,init_latent=x_T,use_original_steps=False,
+                                                 noise_sampler=noise_sampler, img_callback=img_callback,
+                                                 cancel=cancel)
+
+                elif sampler in SAMPLERS:
+                    def k_callback(step):
+                        if cancel is not None:
+                            cancel.check()
+                        if img_callback is not None:
+                            img_callback(step["denoised"], step["i"])
+                    samples = run_sampler(sampler, self, self.alphas_cumprod.to(x_latent.device), x_latent, S,
+                                          conditioning, unconditional_conditioning, unconditional_guidance_scale,
+                                          callback=k_callback, schedule=schedule, noise_sampler=noise_sampler)
+
+                else:
+                    raise ValueError(f"unknown sampler '{sampler}'")
+        finally:
+            if(self.turbo and self.batcher is None):
+                if self.residency is not None:
+                    self.residency.release("unet")
+                else:
+                    self.model1.to("cpu")
+                    self.model2.to("cpu")
+            elif(self.batcher is None):
+                # with a batcher the offload is freed when the last job ends
+                self.free_offload()
 
         return samples
 
@@ -569,7 +675,8 @@ class UNet(DDPM):
                       callback=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, noise_sampler=None,
+                      cancel=None):
 
         device = self.betas.device
         timesteps = self.ddim_timesteps
@@ -581,6 +688,8 @@ class UNet(DDPM):
         old_eps = []
 
         for i, step in enumerate(iterator):
+            if cancel is not None:
+                cancel.check()
             index = total_steps - i - 1
             ts = torch.full((b,), step, device=device, dtype=torch.long)
             ts_next = torch.full((b,), time_range[min(i + 1, len(time_range) - 1)], device=device, dtype=torch.long)
@@ -596,7 +705,7 @@ class UNet(DDPM):
                                       corrector_kwargs=corrector_kwargs,
                                       unconditional_guidance_scale=unconditional_guidance_scale,
                                       unconditional_conditioning=unconditional_conditioning,
-                                      old_eps=old_eps, t_next=ts_next)
+                                      old_eps=old_eps, t_next=ts_next, noise_sampler=noise_sampler)
             img, pred_x0, e_t = outs
             old_eps.append(e_t)
             if len(old_eps) >= 4:
@@ -609,7 +718,8 @@ class UNet(DDPM):
     @torch.no_grad()
     def p_sample_plms(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None,
+                      noise_sampler=None):
         b, *_, device = *x.shape, x.device
 
         def get_model_output(x, t):
@@ -618,7 +728,7 @@ class UNet(DDPM):
             else:
                 x_in = torch.cat([x] * 2)
                 t_in = torch.cat([t] * 2)
-                c_in = torch.cat([unconditional_conditioning, c])
+                c_in = cfg_conditioning(unconditional_conditioning, c)
                 e_t_uncond, e_t = self.apply_model(x_in, t_in, c_in).chunk(2)
                 e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
 
@@ -646,7 +756,8 @@ class UNet(DDPM):
                 pred_x0, _, *_ = self.first_stage_model.quantize(pred_x0)
             # direction pointing to x_t
             dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+            noise = noise_like(x.shape, device, repeat_noise) if noise_sampler is None else noise_sampler(x)
+            noise = sigma_t * noise * temperature
             if noise_dropout > 0.:
                 noise = torch.nn.functional.dropout(noise, p=noise_dropout)
             x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
@@ -674,23 +785,17 @@ class UNet(DDPM):
 
 
     @torch.no_grad()
-    def stochastic_encode(self, x0, t, seed, ddim_eta,ddim_steps,use_original_steps=False, noise=None):
+    def stochastic_encode(self, x0, t, seed, ddim_eta,ddim_steps,use_original_steps=False, noise=None, noise_sampler=None):
         # fast, but does not allow for exact reconstruction
         # t serves as an index to gather the correct alphas
         self.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=ddim_eta, verbose=False)
         sqrt_alphas_cumprod = torch.sqrt(self.ddim_alphas)
 
         if noise is None:
-            b0, b1, b2, b3 = x0.shape
-            img_shape = (1, b1, b2, b3)
-            tens = []
-            print("seeds used = ", [seed+s for s in range(b0)])
-            for _ in range(b0):
-                torch.manual_seed(seed)
-                tens.append(torch.randn(img_shape, device=x0.device))
-                seed+=1
-            noise = torch.cat(tens)
-            del tens
+            if noise_sampler is None:
+                noise_sampler = BatchNoise(seed, x0.shape[0], x0.device)
+            print("seeds used = ", noise_sampler.seeds)
+            noise = noise_sampler(x0)
         return (extract_into_tensor(sqrt_alphas_cumprod, t, x0.shape) * x0 +
                 extract_into_tensor(self.ddim_sqrt_one_minus_alphas, t, x0.shape) * noise)
 
@@ -708,7 +813,8 @@ class UNet(DDPM):
 
     @torch.no_grad()
     def ddim_sampling(self, x_latent, cond, t_start, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
-               mask = None,init_latent=None,use_original_steps=False):
+               mask = None,init_latent=None,use_original_steps=False, noise_sampler=None, img_callback=None,
+               cancel=None):
 
         timesteps = self.ddim_timesteps
         timesteps = timesteps[:t_start]
@@ -720,6 +826,8 @@ class UNet(DDPM):
         x_dec = x_latent
         x0 = init_latent
         for i, step in enumerate(iterator):
+            if cancel is not None:
+                cancel.check()
             index = total_steps - i - 1
             ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
 
@@ -728,9 +836,11 @@ class UNet(DDPM):
                 x0_noisy = x0
                 x_dec = x0_noisy* mask + (1. - mask) * x_dec
 
-            x_dec = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
-                                          unconditional_guidance_scale=unconditional_guidance_scale,
-                                          unconditional_conditioning=unconditional_conditioning)
+            x_dec, pred_x0 = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
+                                                unconditional_guidance_scale=unconditional_guidance_scale,
+                                                unconditional_conditioning=unconditional_conditioning,
+                                                noise_sampler=noise_sampler)
+            if img_callback: img_callback(pred_x0, i)
 
         if mask is not None:
             return x0 * mask + (1. - mask) * x_dec
@@ -741,7 +851,7 @@ class UNet(DDPM):
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, noise_sampler=None):
         b, *_, device = *x.shape, x.device
 
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
@@ -749,7 +859,7 @@ class UNet(DDPM):
         else:
             x_in = torch.cat([x] * 2)
             t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
+            c_in = cfg_conditioning(unconditional_conditioning, c)
             e_t_uncond, e_t = self.apply_model(x_in, t_in, c_in).chunk(2)
             e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
 
@@ -773,260 +883,9 @@ class UNet(DDPM):
             pred_x0, _, *_ = self.first_stage_model.quantize(pred_x0)
         # direction pointing to x_t
         dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+        noise = noise_like(x.shape, device, repeat_noise) if noise_sampler is None else noise_sampler(x)
+        noise = sigma_t * noise * temperature
         if noise_dropout > 0.:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
         x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-        return x_prev
-
-
-    @torch.no_grad()
-    def euler_sampling(self, ac, x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1,extra_args=None,callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1.):
-        """Implements Algorithm 2 (Euler steps) from Karras et al. (2022)."""
-        extra_args = {} if extra_args is None else extra_args
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-            gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-            eps = torch.randn_like(x) * s_noise
-            sigma_hat = (sigmas[i] * (gamma + 1)).half()
-            if gamma > 0:
-                x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
-
-            s_i = sigma_hat * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            d = to_d(x, sigma_hat, denoised)
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
-            dt = sigmas[i + 1] - sigma_hat
-            # Euler method
-            x = x + d * dt
-        return x
-
-    @torch.no_grad()
-    def euler_ancestral_sampling(self,ac,x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1,extra_args=None, callback=None, disable=None):
-        """Ancestral sampling with Euler method steps."""
-        extra_args = {} if extra_args is None else extra_args
-
-
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-
-            s_i = sigmas[i] * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-            sigma_down, sigma_up = get_ancestral_step(sigmas[i], sigmas[i + 1])
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
-            d = to_d(x, sigmas[i], denoised)
-            # Euler method
-            dt = sigma_down - sigmas[i]
-            x = x + d * dt
-            x = x + torch.randn_like(x) * sigma_up
-        return x
-
-
-
-    @torch.no_grad()
-    def heun_sampling(self, ac, x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1, extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1.):
-        """Implements Algorithm 2 (Heun steps) from Karras et al. (2022)."""
-        extra_args = {} if extra_args is None else extra_args
-
-        cvd = CompVisDenoiser(alphas_cumprod=ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-            gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-            eps = torch.randn_like(x) * s_noise
-            sigma_hat = (sigmas[i] * (gamma + 1)).half()
-            if gamma > 0:
-                x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
-
-            s_i = sigma_hat * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-            d = to_d(x, sigma_hat, denoised)
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
-            dt = sigmas[i + 1] - sigma_hat
-            if sigmas[i + 1] == 0:
-                # Euler method
-                x = x + d * dt
-            else:
-                # Heun's method
-                x_2 = x + d * dt
-                s_i = sigmas[i + 1] * s_in
-                x_in = torch.cat([x_2] * 2)
-                t_in = torch.cat([s_i] * 2)
-                cond_in = torch.cat([unconditional_conditioning, cond])
-                c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-                eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-                e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-                denoised_2 = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-                d_2 = to_d(x_2, sigmas[i + 1], denoised_2)
-                d_prime = (d + d_2) / 2
-                x = x + d_prime * dt
-        return x
-
-
-    @torch.no_grad()
-    def dpm_2_sampling(self,ac,x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1,extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1.):
-        """A sampler inspired by DPM-Solver-2 and Algorithm 2 from Karras et al. (2022)."""
-        extra_args = {} if extra_args is None else extra_args
-
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-            gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-            eps = torch.randn_like(x) * s_noise
-            sigma_hat = sigmas[i] * (gamma + 1)
-            if gamma > 0:
-                x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
-
-            s_i = sigma_hat * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-
-            d = to_d(x, sigma_hat, denoised)
-            # Midpoint method, where the midpoint is chosen according to a rho=3 Karras schedule
-            sigma_mid = ((sigma_hat ** (1 / 3) + sigmas[i + 1] ** (1 / 3)) / 2) ** 3
-            dt_1 = sigma_mid - sigma_hat
-            dt_2 = sigmas[i + 1] - sigma_hat
-            x_2 = x + d * dt_1
-
-            s_i = sigma_mid * s_in
-            x_in = torch.cat([x_2] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised_2 = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            d_2 = to_d(x_2, sigma_mid, denoised_2)
-            x = x + d_2 * dt_2
-        return x
-
-
-    @torch.no_grad()
-    def dpm_2_ancestral_sampling(self,ac,x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1, extra_args=None, callback=None, disable=None):
-        """Ancestral sampling with DPM-Solver inspired second-order steps."""
-        extra_args = {} if extra_args is None else extra_args
-
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-
-            s_i =  sigmas[i] * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            sigma_down, sigma_up = get_ancestral_step(sigmas[i], sigmas[i + 1])
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
-            d = to_d(x, sigmas[i], denoised)
-            # Midpoint method, where the midpoint is chosen according to a rho=3 Karras schedule
-            sigma_mid = ((sigmas[i] ** (1 / 3) + sigma_down ** (1 / 3)) / 2) ** 3
-            dt_1 = sigma_mid - sigmas[i]
-            dt_2 = sigma_down - sigmas[i]
-            x_2 = x + d * dt_1
-
-            s_i = sigma_mid * s_in
-            x_in = torch.cat([x_2] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised_2 = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            d_2 = to_d(x_2, sigma_mid, denoised_2)
-            x = x + d_2 * dt_2
-            x = x + torch.randn_like(x) * sigma_up
-        return x
-
-
-    @torch.no_grad()
-    def lms_sampling(self,ac,x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1, extra_args=None, callback=None, disable=None, order=4):
-        extra_args = {} if extra_args is None else extra_args
-        s_in = x.new_ones([x.shape[0]])
-
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        ds = []
-        for i in trange(len(sigmas) - 1, disable=disable):
-
-            s_i =  sigmas[i] * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            d = to_d(x, sigmas[i], denoised)
-            ds.append(d)
-            if len(ds) > order:
-                ds.pop(0)
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
-            cur_order = min(i + 1, order)
-            coeffs = [linear_multistep_coeff(cur_order, sigmas.cpu(), i, j) for j in range(cur_order)]
-            x = x + sum(coeff * d for coeff, d in zip(coeffs, reversed(ds)))
-        return x
+        return x_prev, pred_x0
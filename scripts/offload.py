@@ -0,0 +1,266 @@
+"""
+Overlapped weight offloading for the low VRAM mode.
+
+Weights of every unit (a module such as one block of the split UNet) are
+packed once into a pinned host buffer which stays their master copy, so
+evicting a unit is only repointing its parameters back to host memory and
+never copies anything back from the device. Units are uploaded into
+reused device buffers on a side stream, and while one unit computes the
+next one is already uploaded when the budget has room for it.
+
+All device operations go through a backend so the scheduling can be
+followed on a machine without GPU by using CPUBackend.
+"""
+import time
+import torch
+
+
+ALIGNMENT = 256
+
+
+class CUDABackend:
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+
+    def pin(self, nbytes):
+        return torch.empty(nbytes, dtype=torch.uint8).pin_memory()
+
+    def alloc(self, nbytes):
+        return torch.empty(nbytes, dtype=torch.uint8, device=self.device)
+
+    def upload(self, dst, src, start=None):
+        """copies src into dst on the side stream once queued compute is done"""
+        ready = torch.cuda.Event()
+        ready.record(torch.cuda.current_stream(self.device))
+        done = torch.cuda.Event(enable_timing=start is not None)
+        with torch.cuda.stream(self.stream):
+            self.stream.wait_event(ready)
+            if start is not None:
+                start.record(self.stream)
+            dst.copy_(src, non_blocking=True)
+            done.record(self.stream)
+        # the buffer may be dropped before the copy finished
+        dst.record_stream(self.stream)
+        return done
+
+    def upload_timed(self, dst, src):
+        """like upload, also returns an event recorded when the copy starts"""
+        start = torch.cuda.Event(enable_timing=True)
+        return start, self.upload(dst, src, start=start)
+
+    def elapsed_ms(self, start, done):
+        done.synchronize()
+        return start.elapsed_time(done)
+
+    def wait(self, event):
+        torch.cuda.current_stream(self.device).wait_event(event)
+
+
+class CPUBackend:
+    """
+    synchronous backend for CPU devices, it records every operation in
+    log so the scheduling of an engine can be inspected
+    """
+    def __init__(self, device="cpu"):
+        self.device = torch.device(device)
+        self.log = []
+
+    def pin(self, nbytes):
+        return torch.empty(nbytes, dtype=torch.uint8)
+
+    def alloc(self, nbytes):
+        self.log.append(("alloc", nbytes))
+        return torch.empty(nbytes, dtype=torch.uint8)
+
+    def upload(self, dst, src):
+        self.log.append(("upload", src.nelement()))
+        dst.copy_(src)
+        return None
+
+    def upload_timed(self, dst, src):
+        start = time.perf_counter()
+        self.upload(dst, src)
+        return start, time.perf_counter()
+
+    def elapsed_ms(self, start, done):
+        return (done - start) * 1000
+
+    def wait(self, event):
+        self.log.append(("wait",))
+
+
+def make_backend(device):
+    if torch.device(device).type == "cuda":
+        return CUDABackend(device)
+    return CPUBackend(device)
+
+
+class Unit:
+    """tensors of one module packed into a pinned host buffer"""
+    def __init__(self, module, backend):
+        self.module = module
+        self.tensors = []
+        offset = 0
+        for param in module.parameters():
+            offset = self._add(("param", param), param.data, offset)
+        for owner in module.modules():
+            for name, buffer in owner._buffers.items():
+                if buffer is not None:
+                    offset = self._add(("buffer", owner, name), buffer, offset)
+        self.nbytes = offset
+
+        self.host = backend.pin(self.nbytes)
+        for ref, tensor, begin, nbytes in self.tensors:
+            self.host[begin:begin + nbytes].copy_(tensor.detach().reshape(-1).view(torch.uint8))
+        self.storage = None
+        self.point_to(self.host)
+
+    def _add(self, ref, tensor, offset):
+        nbytes = tensor.element_size() * tensor.nelement()
+        self.tensors.append((ref, tensor, offset, nbytes))
+        return offset + nbytes + (-nbytes % ALIGNMENT)
+
+    def point_to(self, storage):
+        """makes parameters and buffers of the module views into storage"""
+        if storage is self.storage:
+            return
+        self.storage = storage
+        for i, (ref, tensor, begin, nbytes) in enumerate(self.tensors):
+            view = storage[begin:begin + nbytes].view(tensor.dtype).view(tensor.shape)
+            if ref[0] == "param":
+                ref[1].data = view
+            else:
+                ref[1]._buffers[ref[2]] = view
+            self.tensors[i] = (ref, view, begin, nbytes)
+
+
+class OffloadEngine:
+    """
+    keeps units resident on the device within a budget of bytes.
+
+    Units are expected to run in the order they are given, over and over,
+    which the prefetch of the next unit and lookahead eviction rely on.
+    Lookahead evicts the unit needed again last, lru the one used longest
+    ago. Device buffers of evicted units are kept for the next upload of a
+    unit of similar size and count towards the budget.
+    """
+    POLICIES = ("lookahead", "lru")
+
+    def __init__(self, modules, device, budget=None, policy="lookahead", backend=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown eviction policy '{policy}'")
+        self.backend = backend if backend is not None else make_backend(device)
+        self.units = [Unit(module, self.backend) for module in modules]
+        largest = max(unit.nbytes for unit in self.units)
+        total = sum(unit.nbytes for unit in self.units)
+        # the running unit has to fit, more than every unit is never needed
+        self.budget = total if budget is None else min(max(budget, largest), total)
+        self.policy = policy
+        self.buffers = {}
+        self.spare = []
+        self.used = 0
+        self.pending = {}
+        self.last_used = {}
+        self.clock = 0
+        self.position = 0
+        self.hooks = []
+
+    def attach(self):
+        """activates every unit right before its module runs"""
+        for index, unit in enumerate(self.units):
+            hook = lambda module, inputs, index=index: self.activate(index)
+            self.hooks.append(unit.module.register_forward_pre_hook(hook))
+        return self
+
+    def detach(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def _distance(self, index):
+        """units the position has to advance until unit index runs again"""
+        return (index - self.position) % len(self.units)
+
+    def _victim(self, keep):
+        resident = [index for index in self.buffers if index not in keep]
+        if not resident:
+            return None
+        if self.policy == "lru":
+            return min(resident, key=lambda index: self.last_used.get(index, -1))
+        return max(resident, key=self._distance)
+
+    def _take_spare(self, nbytes):
+        fitting = [buffer for buffer in self.spare if buffer.nelement() >= nbytes]
+        if not fitting:
+            return None
+        buffer = min(fitting, key=lambda buffer: buffer.nelement())
+        self.spare.remove(buffer)
+        return buffer
+
+    def _evict(self, index):
+        unit = self.units[index]
+        unit.point_to(unit.host)
+        self.spare.append(self.buffers.pop(index))
+        self.pending.pop(index, None)
+
+    def _reserve(self, nbytes, keep=()):
+        """
+        returns a device buffer of at least nbytes, evicting units other
+        than keep to stay within the budget, or None when that isn't enough
+        """
+        buffer = self._take_spare(nbytes)
+        while buffer is None and self.used + nbytes > self.budget:
+            if self.spare:
+                self.used -= self.spare.pop().nelement()
+                continue
+            victim = self._victim(keep)
+            if victim is None:
+                return None
+            self._evict(victim)
+            buffer = self._take_spare(nbytes)
+        if buffer is None:
+            buffer = self.backend.alloc(nbytes)
+            self.used += nbytes
+        return buffer
+
+    def _upload(self, index, buffer):
+        unit = self.units[index]
+        self.pending[index] = self.backend.upload(buffer[:unit.nbytes], unit.host)
+        self.buffers[index] = buffer
+
+    def activate(self, index):
+        """makes unit index usable on the device and prefetches the next one"""
+        self.position = index
+        unit = self.units[index]
+        if index not in self.buffers:
+            self._upload(index, self._reserve(unit.nbytes))
+        event = self.pending.pop(index, None)
+        if event is not None:
+            self.backend.wait(event)
+        unit.point_to(self.buffers[index])
+        self.clock += 1
+        self.last_used[index] = self.clock
+
+        nxt = (index + 1) % len(self.units)
+        if nxt not in self.buffers:
+            buffer = self._reserve(self.units[nxt].nbytes, keep=(index,))
+            if buffer is not None:
+                self._upload(nxt, buffer)
+
+    def release(self):
+        """points every unit back to its host copy, device buffers are kept"""
+        for index in list(self.buffers):
+            self._evict(index)
+        self.position = 0
+
+    def free(self):
+        """releases the units and gives the device memory back"""
+        self.release()
+        self.spare = []
+        self.used = 0
+
+
+def module_bytes(module):
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.element_size() * t.nelement() for t in tensors)
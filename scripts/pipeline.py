@@ -0,0 +1,547 @@
+import os, threading
+import torch
+import numpy as np
+from omegaconf import OmegaConf
+from PIL import Image
+from tqdm import tqdm, trange
+from itertools import islice
+from einops import repeat
+from torch import autocast
+from contextlib import nullcontext
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime #Fluffy: For adding dates to output dir
+from ldm.util import instantiate_from_config
+from ldm.modules.diffusionmodules.model import attn_chunking
+from ldm.modules.attention import set_attention_backend
+from prompts import read_prompts, read_jobs, group_jobs, parse_prompt
+from condcache import ConditioningCache
+from tensorfile import TensorFile, is_tensorfile
+from residency import ResidencyManager
+from samplers import BatchNoise
+from preview import Previewer
+import safeloader
+import simulacra
+
+
+CONFIG = "scripts/v1-inference.yaml"
+
+Models = namedtuple("Models", ["model", "modelCS", "modelFS", "residency"])
+
+#Fluffy: Add date to output path
+OUT_PROMPT_TR = {
+    ord(' '): '_',
+    ord('/'): None,
+    ord('\\'): None,
+    ord(':'): None,
+    ord(';'): None,
+    ord('?'): None,
+    ord('*'): None,
+}
+
+# threads encoding and writing decoded images
+SAVE_WORKERS = min(4, os.cpu_count() or 1)
+
+# jobs of the generation server share the cond stage model
+cond_stage_lock = threading.Lock()
+
+
+def chunk(it, size):
+    it = iter(it)
+    return iter(lambda: tuple(islice(it, size)), ())
+
+
+def load_model_from_config(ckpt, verbose=False):
+    print(f"Loading model from {ckpt}")
+    pl_sd = torch.load(ckpt, map_location="cpu")
+    if "global_step" in pl_sd:
+        print(f"Global Step: {pl_sd['global_step']}")
+    sd = pl_sd["state_dict"]
+    return sd
+
+
+def split_unet_state_dict(sd):
+    """
+    renames "model." keys of the state dict in place into "model1." keys
+    (input_blocks, middle_block and time_embed) and "model2." keys (the
+    rest) so they match the split UNet
+    """
+    li, lo = [], []
+    for key, value in sd.items():
+        sp = key.split(".")
+        if (sp[0]) == "model":
+            if "input_blocks" in sp:
+                li.append(key)
+            elif "middle_block" in sp:
+                li.append(key)
+            elif "time_embed" in sp:
+                li.append(key)
+            else:
+                lo.append(key)
+    for key in li:
+        sd["model1." + key[6:]] = sd.pop(key)
+    for key in lo:
+        sd["model2." + key[6:]] = sd.pop(key)
+    return sd
+
+
+def load_models(ckpt, device, precision, unet_bs=1, turbo=False,
+                unet_budget=None, unet_policy="lookahead", vram_budget=None,
+                attention="auto",
+                half_first_stage=False, cond_cache_dir=None, config=CONFIG):
+    """
+    loads the checkpoint once and builds UNet, CondStage and FirstStage
+    models from it
+    """
+    if is_tensorfile(ckpt):
+        # memory-mapped, every model pages in only its own tensors
+        print(f"Loading model from {ckpt}")
+        tf = TensorFile(ckpt)
+        state_dict = tf.state_dict
+    else:
+        tf = None
+        sd = split_unet_state_dict(load_model_from_config(f"{ckpt}"))
+        state_dict = lambda prefixes=None, exclude=(): sd
+
+    config = OmegaConf.load(f"{config}")
+    set_attention_backend(attention)
+
+    model = instantiate_from_config(config.modelUNet)
+    # .safetensors files not written by convert_ckpt.py still have "model." keys
+    missing, _ = model.load_state_dict(split_unet_state_dict(state_dict(exclude=("cond_stage_model.",
+                                                                                 "first_stage_model.",
+                                                                                 "model_ema."))),
+                                       strict=False)
+    missing = [key for key in missing if key.startswith(("model1.", "model2."))]
+    if missing:
+        raise ValueError(f"{ckpt} has no weights for {len(missing)} UNet parameters, e.g. {missing[0]}")
+    model.eval()
+    model.unet_bs = unet_bs
+    model.cdevice = device
+    model.turbo = turbo
+    if unet_budget is not None:
+        model.offload_budget = unet_budget * 2**20
+    model.offload_policy = unet_policy
+
+    modelCS = instantiate_from_config(config.modelCondStage)
+    _, _ = modelCS.load_state_dict(state_dict(prefixes=("cond_stage_model.",)), strict=False)
+    modelCS.eval()
+    modelCS.cond_stage_model.device = device
+    modelCS.cond_cache = ConditioningCache(cache_dir=cond_cache_dir)
+
+    modelFS = instantiate_from_config(config.modelFirstStage)
+    _, _ = modelFS.load_state_dict(state_dict(prefixes=("first_stage_model.",)), strict=False)
+    modelFS.eval()
+    if tf is not None:
+        tf.close()
+    else:
+        del sd
+
+    if device != "cpu" and precision == "autocast":
+        model.half()
+        modelCS.half()
+        if half_first_stage:
+            modelFS.half()
+
+    residency = ResidencyManager(device,
+                                 budget=vram_budget * 2**20 if vram_budget is not None else None)
+    if turbo:
+        residency.register("unet", model.model1, model.model2)
+        model.residency = residency
+    residency.register("cond_stage", modelCS)
+    residency.register("first_stage", modelFS)
+
+    return Models(model, modelCS, modelFS, residency)
+
+
+def get_precision_scope(opt):
+    if opt.precision == "autocast" and opt.device != "cpu":
+        return autocast
+    return nullcontext
+
+
+def make_outpath(opt):
+    curDT = datetime.now() #Get current date and time
+    date_time_str = curDT.strftime("%Y-%m-%d\%H-%M ") + opt.prompt.translate(OUT_PROMPT_TR)[:50] #Create string with date and time and parts of the prompt (limit to 50 characters)
+    outpath = os.path.join(opt.outdir, date_time_str) #Add date and time to final output path
+    os.makedirs(outpath, exist_ok=True)
+    return outpath
+
+
+def compile_prompt(encoder, prompt):
+    """
+    [(sequence, weight)] of the sub-prompts of prompt (see parse_prompt),
+    a sequence being the (token ids, token weights) of a sub-prompt
+    """
+    parts = parse_prompt(prompt) or [([("", 1.0)], 1.0)]
+    runs = [run for part_runs, _ in parts for run in part_runs]
+    # all runs are tokenized in one call
+    ids = iter(encoder.tokenize([text for text, _ in runs]))
+    compiled = []
+    for part_runs, weight in parts:
+        tokens, token_weights = [], []
+        for _, emphasis in part_runs:
+            run_ids = next(ids)
+            tokens += run_ids
+            token_weights += [emphasis] * len(run_ids)
+        compiled.append(((tuple(tokens), tuple(token_weights)), weight))
+    return compiled
+
+
+def vectorize_texts(modelCS, texts):
+    """
+    conditioning of every prompt of texts, the sub-prompts of all of them
+    are encoded in one batch and blended by their weights. Prompts longer
+    than one window of the text encoder are encoded window by window, and
+    all prompts get as many windows as the longest one needs.
+    """
+    encoder = modelCS.cond_stage_model
+    compiled = [compile_prompt(encoder, text) for text in texts]
+    windows = max(encoder.windows(ids) for parts in compiled for (ids, _), _ in parts)
+    compiled = [[((ids, token_weights, windows), weight) for (ids, token_weights), weight in parts]
+                for parts in compiled]
+    sequences = list(dict.fromkeys(sequence for parts in compiled for sequence, _ in parts))
+    conds = modelCS.get_learned_conditioning(sequences)
+
+    index = {sequence: i for i, sequence in enumerate(sequences)}
+    blend = torch.zeros(len(texts), len(sequences))
+    for row, parts in enumerate(compiled):
+        weights_sum = sum(weight for _, weight in parts) or 1.0
+        for sequence, weight in parts:
+            blend[row, index[sequence]] += weight / weights_sum
+    return torch.einsum("ts,s...->t...", blend.to(conds.device, conds.dtype), conds)
+
+
+def vectorize_prompts(modelCS, residency, opt, batch_size, prompts):
+    if isinstance(prompts, tuple):
+        prompts = list(prompts)
+    # the prompt and the negative prompt go through the text encoder together
+    texts = [prompts[0]] if opt.scale == 1.0 else [prompts[0], opt.nprompt]
+    with cond_stage_lock, residency.use("cond_stage"):
+        conds = vectorize_texts(modelCS, texts)
+    c = conds[:1].repeat(batch_size, 1, 1)
+    uc = None
+    if opt.scale != 1.0:
+        uc = conds[1:].repeat(batch_size, 1, 1)
+    return c, uc
+
+
+def vectorize_jobs(modelCS, residency, jobs, scale):
+    """conditioning of a batch with its own prompt and negative prompt in every slot"""
+    texts = [job["prompt"] for job in jobs]
+    if scale != 1.0:
+        texts += [job["nprompt"] for job in jobs]
+    with cond_stage_lock, residency.use("cond_stage"):
+        conds = vectorize_texts(modelCS, texts)
+    c = conds[:len(jobs)]
+    uc = None
+    if scale != 1.0:
+        uc = conds[len(jobs):]
+    return c, uc
+
+
+def load_img(path, h0, w0):
+    image = Image.open(path).convert("RGB")
+    w, h = image.size
+
+    print(f"loaded input image of size ({w}, {h}) from {path}")
+    if h0 is not None and w0 is not None:
+        h, w = h0, w0
+
+    w, h = map(lambda x: x - x % 64, (w, h))  # resize to integer multiple of 32
+
+    print(f"New image size ({w}, {h})")
+    image = image.resize((w, h), resample=Image.LANCZOS)
+    image = np.array(image).astype(np.float32) / 255.0
+    image = image[None].transpose(0, 3, 1, 2)
+    image = torch.from_numpy(image)
+    return 2.0 * image - 1.0
+
+
+def load_mask(mask, h0, w0, newH, newW, invert=False):
+    image = Image.open(mask).convert("RGB")
+    w, h = image.size
+    print(f"loaded input mask of size ({w}, {h})")
+    if h0 is not None and w0 is not None:
+        h, w = h0, w0
+
+    w, h = map(lambda x: x - x % 64, (w, h))  # resize to integer multiple of 32
+
+    print(f"New mask size ({w}, {h})")
+    image = image.resize((newW, newH), resample=Image.LANCZOS)
+    # image = image.resize((64, 64), resample=Image.LANCZOS)
+    image = np.array(image)
+
+    if invert:
+        print("inverted")
+        where_0, where_1 = np.where(image == 0), np.where(image == 255)
+        image[where_0], image[where_1] = 255, 0
+    image = image.astype(np.float32) / 255.0
+    image = image[None].transpose(0, 3, 1, 2)
+    image = torch.from_numpy(image)
+    return image
+
+
+def decode_samples(modelFS, residency, opt, samples_ddim, stage=nullcontext):
+    """
+    decodes latents in micro-batches of opt.decode_bs on opt.decode_device
+    and yields every micro-batch as a uint8 NHWC array
+    """
+    device = opt.decode_device
+    dtype = next(modelFS.parameters()).dtype
+    scope = residency.use("first_stage") if device != "cpu" else nullcontext()
+    with scope:
+        for i in range(0, samples_ddim.shape[0], opt.decode_bs):
+            with stage("decode"):
+                z = samples_ddim[i:i + opt.decode_bs].to(device=device, dtype=dtype)
+                with attn_chunking(opt.vae_attn_chunk):
+                    if opt.decode_mem is not None:
+                        x = modelFS.decode_first_stage_tiled(z, opt.decode_mem * 2**20)
+                    else:
+                        x = modelFS.decode_first_stage(z)
+                del z
+                x = (255.0 * torch.clamp((x + 1.0) / 2.0, min=0.0, max=1.0)).to(torch.uint8)
+                images = x.permute(0, 2, 3, 1).cpu().numpy()
+                del x
+            yield images
+
+
+def encode_image(modelFS, residency, opt, image):
+    """encodes images on opt.decode_device and returns their latents on opt.device"""
+    device = opt.decode_device
+    scope = residency.use("first_stage") if device != "cpu" else nullcontext()
+    with scope, attn_chunking(opt.vae_attn_chunk):
+        image = image.to(device=device, dtype=next(modelFS.parameters()).dtype)
+        latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(image))
+        return latent.to(opt.device)
+
+
+def save_image(image, dest_path):
+    Image.fromarray(image).save(dest_path)
+    return dest_path
+
+
+def save_samples(modelFS, residency, opt, outpath, samples_ddim, batch_size, seeds=None, names=None,
+                 stage=nullcontext):
+    """
+    decodes latents, writes them into outpath on a thread pool and yields
+    (seed, path, score) of every image in order. Without seeds they count
+    up from opt.seed, which is advanced past them. With an aesthetic
+    threshold images are scored before saving, the path of images scoring
+    below it is None and they are never written, otherwise score is None.
+    stage(name) is entered around the decoding and scoring of every batch.
+    """
+    print(samples_ddim.shape)
+    print("saving images")
+    pending = []
+    with ThreadPoolExecutor(max_workers=SAVE_WORKERS) as pool:
+        index = 0
+        for images in decode_samples(modelFS, residency, opt, samples_ddim[:batch_size], stage):
+            scores = [None] * len(images)
+            if opt.aesthetic_threshold > 0:
+                with stage("aesthetic"):
+                    scores = simulacra.scorer.score(images)
+            # images of the previous micro-batch are encoded while this one decodes
+            for image, score in zip(images, scores):
+                if seeds is None:
+                    seed = opt.seed
+                    opt.seed += 1
+                else:
+                    seed = seeds[index]
+                index += 1
+                if score is not None and score < opt.aesthetic_threshold:
+                    pending.append((seed, None, score))
+                    continue
+                name = f"seed_{seed}.{opt.format}" if names is None else names[index - 1] #Fluffy: Removed base_count
+                dest_path = os.path.join(outpath, name) #Fluffy: Replaced sample_path with outpath
+                pending.append((seed, pool.submit(save_image, image, dest_path), score))
+            while pending and (pending[0][1] is None or pending[0][1].done()):
+                seed, future, score = pending.pop(0)
+                yield seed, None if future is None else future.result(), score
+        for seed, future, score in pending:
+            yield seed, None if future is None else future.result(), score
+
+    del samples_ddim
+
+
+def make_previewer(opt, preview):
+    if preview is None or not opt.preview_every:
+        return None
+    return Previewer(opt.preview_every, preview)
+
+
+@torch.no_grad()
+def txt2img(models, opt, outpath, preview=None, cancel=None, stage=nullcontext, jobs=None):
+    """
+    runs the txt2img sampling loop described by opt and yields
+    (seed, path, score) of every image (see save_samples), with opt.preview_every
+    preview(step, images) receives progress previews. Sampling stops
+    with Cancelled once the CancelToken cancel is cancelled. stage(name)
+    is entered around every stage of the work, e.g. runlog.Run.stage.
+    jobs are the lines of opt.from_jsonl if they were read already.
+    """
+    model, modelCS, modelFS, residency = models
+    img_callback = make_previewer(opt, preview)
+
+    if getattr(opt, "from_jsonl", None):
+        yield from txt2img_jobs(models, opt, outpath, img_callback, cancel, stage, jobs)
+        return
+
+    start_code = None
+    if opt.fixed_code:
+        start_code = torch.randn([opt.n_samples, opt.C, opt.H // opt.f, opt.W // opt.f], device=opt.device)
+
+    batch_size = opt.n_samples
+    data = read_prompts(opt, batch_size)
+    precision_scope = get_precision_scope(opt)
+
+    for n in trange(opt.n_iter, desc="Sampling"):
+        for prompts in tqdm(data, desc="data"):
+            #Fluffy: Removed a few lines related to file path since we've changed how create path for images
+
+            with precision_scope("cuda"):
+                with stage("conditioning"):
+                    c, uc = vectorize_prompts(modelCS, residency, opt, batch_size, prompts)
+                shape = [opt.n_samples, opt.C, opt.H // opt.f, opt.W // opt.f]
+
+                with stage("sampling"):
+                    samples_ddim = model.sample(
+                        S=opt.ddim_steps,
+                        conditioning=c,
+                        seed=opt.seed,
+                        shape=shape,
+                        verbose=False,
+                        unconditional_guidance_scale=opt.scale,
+                        unconditional_conditioning=uc,
+                        eta=opt.ddim_eta,
+                        x_T=start_code,
+                        sampler = opt.sampler,
+                        schedule = opt.schedule,
+                        img_callback=img_callback,
+                        cancel=cancel,
+                    )
+
+                yield from save_samples(modelFS, residency, opt, outpath, samples_ddim, batch_size, stage=stage)
+                del samples_ddim
+                if opt.device != "cpu":
+                    print("memory_final = ", torch.cuda.memory_allocated(device=opt.device) / 1e6)
+
+
+def txt2img_jobs(models, opt, outpath, img_callback, cancel, stage=nullcontext, jobs=None):
+    """
+    bulk txt2img of a --from-jsonl file, one image per line, batched
+    n_samples lines at a time. The file is read unless its jobs are given.
+    """
+    model, modelCS, modelFS, residency = models
+    precision_scope = get_precision_scope(opt)
+
+    lines = jobs
+    if lines is None:
+        print(f"reading jobs from {opt.from_jsonl}")
+        lines = read_jobs(opt.from_jsonl, opt)
+    for (H, W, steps, scale), jobs in group_jobs(lines, opt.n_samples):
+        with precision_scope("cuda"):
+            with stage("conditioning"):
+                c, uc = vectorize_jobs(modelCS, residency, jobs, scale)
+            seeds = [job["seed"] for job in jobs]
+            with stage("sampling"):
+                samples_ddim = model.sample(
+                    S=steps,
+                    conditioning=c,
+                    seed=seeds,
+                    shape=[len(jobs), opt.C, H // opt.f, W // opt.f],
+                    verbose=False,
+                    unconditional_guidance_scale=scale,
+                    unconditional_conditioning=uc,
+                    eta=opt.ddim_eta,
+                    sampler=opt.sampler,
+                    schedule=opt.schedule,
+                    img_callback=img_callback,
+                    cancel=cancel,
+                )
+            names = [f"{job['index']:05}_seed_{job['seed']}.{opt.format}" for job in jobs]
+            yield from save_samples(modelFS, residency, opt, outpath, samples_ddim, len(jobs),
+                                    seeds=seeds, names=names, stage=stage)
+            del samples_ddim, c, uc
+
+
+@torch.no_grad()
+def img2img(models, opt, outpath, preview=None, cancel=None, stage=nullcontext):
+    """
+    runs the img2img sampling loop described by opt and yields
+    (seed, path, score) of every image (see save_samples), with opt.preview_every
+    preview(step, images) receives progress previews. Sampling stops
+    with Cancelled once the CancelToken cancel is cancelled. stage(name)
+    is entered around every stage of the work, e.g. runlog.Run.stage.
+    """
+    model, modelCS, modelFS, residency = models
+    img_callback = make_previewer(opt, preview)
+
+    assert os.path.isfile(opt.init_img)
+    init_image = load_img(opt.init_img, opt.H, opt.W)
+
+    batch_size = opt.n_samples
+    data = read_prompts(opt, batch_size)
+
+    init_image = repeat(init_image, "1 ... -> b ...", b=batch_size)
+    with stage("encode"):
+        init_latent = encode_image(modelFS, residency, opt, init_image)  # move to latent space
+
+    mask = None
+    if opt.mask is not None:
+        mask = load_mask(opt.mask,
+                         opt.H,
+                         opt.W,
+                         init_latent.shape[2],
+                         init_latent.shape[3],
+                         not opt.invert_mask).to(opt.device)
+        mask = mask[0][0].unsqueeze(0).repeat(4, 1, 1).unsqueeze(0)
+        mask = repeat(mask,
+                      "1 ... -> b ...",
+                      b=batch_size)
+
+    assert 0.0 <= opt.strength <= 1.0, "can only work with strength in [0.0, 1.0]"
+    t_enc = int(opt.strength * opt.ddim_steps)
+    print(f"target t_enc is {t_enc} steps")
+
+    precision_scope = get_precision_scope(opt)
+
+    for n in trange(opt.n_iter, desc="Sampling"):
+        for prompts in tqdm(data, desc="data"):
+            #Fluffy: Removed a few lines related to file path since we've changed how create path for images
+
+            with precision_scope("cuda"):
+                with stage("conditioning"):
+                    c, uc = vectorize_prompts(modelCS, residency, opt, batch_size, prompts)
+
+                # encoding and sampling draw from the same per image generators
+                noise_sampler = BatchNoise(opt.seed, batch_size, opt.device)
+                with stage("sampling"):
+                    # encode (scaled latent)
+                    z_enc = model.stochastic_encode(
+                        init_latent,
+                        torch.tensor([t_enc] * batch_size).to(opt.device),
+                        opt.seed,
+                        opt.ddim_eta,
+                        opt.ddim_steps,
+                        noise_sampler=noise_sampler,
+                    )
+                    # decode it
+                    samples_ddim = model.sample(
+                        t_enc,
+                        c,
+                        z_enc,
+                        unconditional_guidance_scale=opt.scale,
+                        unconditional_conditioning=uc,
+                        mask=mask,
+                        x_T=init_latent,
+                        sampler=opt.sampler,
+                        noise_sampler=noise_sampler,
+                        img_callback=img_callback,
+                        cancel=cancel,
+                    )
+
+                yield from save_samples(modelFS, residency, opt, outpath, samples_ddim, batch_size, stage=stage)
+                del samples_ddim
+                if opt.device != "cpu":
+                    print("memory_final = ", torch.cuda.memory_allocated(device=opt.device) / 1e6)
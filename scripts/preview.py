@@ -0,0 +1,49 @@
+"""
+Cheap previews of images while they are sampled.
+
+Instead of running the VAE, the predicted denoised latents are projected
+to RGB with a fixed linear map fitted to AutoencoderKL.decode of SD v1.
+That gives one pixel per latent (64x64 for a 512x512 image) at the cost
+of a tiny matmul.
+"""
+import torch
+from PIL import Image
+
+
+# RGB contribution of each of the 4 (scaled) latent channels
+LATENT_RGB = torch.tensor([
+    [ 0.298,  0.207,  0.208],
+    [ 0.187,  0.286,  0.173],
+    [-0.158,  0.189,  0.264],
+    [-0.184, -0.271, -0.473],
+])
+
+
+def latent_to_rgb(latents):
+    """approximate images of latents (b, 4, h, w) as uint8 (b, h, w, 3) on the CPU"""
+    rgb = torch.einsum("bchw,cr->bhwr", latents.float(), LATENT_RGB.to(latents.device))
+    return ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8).cpu()
+
+
+def strip(images):
+    """pastes images next to each other"""
+    out = Image.new("RGB", (sum(image.width for image in images), max(image.height for image in images)))
+    x = 0
+    for image in images:
+        out.paste(image, (x, 0))
+        x += image.width
+    return out
+
+
+class Previewer:
+    """
+    img_callback of UNet.sample calling emit(step, images) with preview
+    images of the batch after every `every` steps
+    """
+    def __init__(self, every, emit):
+        self.every = every
+        self.emit = emit
+
+    def __call__(self, x0, i):
+        if (i + 1) % self.every == 0:
+            self.emit(i + 1, [Image.fromarray(rgb.numpy()) for rgb in latent_to_rgb(x0)])
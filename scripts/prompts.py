@@ -0,0 +1,142 @@
+"""
+Reading the prompts of a run and parsing their weights. Only needs the
+standard library, so the scripts can check a prompt file before torch
+and the models are loaded.
+"""
+import json, re
+
+
+def read_prompts(opt, batch_size):
+    if not opt.from_file:
+        assert opt.prompt is not None
+        prompt = opt.prompt
+        print(f"Using prompt: {prompt}")
+        return [batch_size * [prompt]]
+
+    print(f"reading prompts from {opt.from_file}")
+    with open(opt.from_file, "r") as f:
+        text = f.read()
+        print(f"Using prompt: {text.strip()}")
+        # every prompt fills a whole batch
+        return [batch_size * [prompt] for prompt in sorted(text.splitlines())]
+
+
+# settings a line of a --from-jsonl file may have
+JOB_KEYS = ("prompt", "nprompt", "seed", "steps", "scale", "H", "W")
+
+
+def read_jobs(path, opt):
+    """
+    yields the settings of every line of a JSONL prompt file, the ones
+    missing are taken from opt and seeds count up from opt.seed by line
+    """
+    with open(path, "r") as f:
+        for index, line in enumerate(f):
+            if not line.strip():
+                continue
+            params = json.loads(line)
+            if not isinstance(params, dict) or "prompt" not in params:
+                raise ValueError(f"{path}:{index + 1}: expected a JSON object with a prompt")
+            unknown = set(params) - set(JOB_KEYS)
+            if unknown:
+                raise ValueError(f"{path}:{index + 1}: unknown settings {sorted(unknown)}")
+            yield {"index": index,
+                   "prompt": params["prompt"],
+                   "nprompt": params.get("nprompt", opt.nprompt),
+                   "seed": int(params.get("seed", opt.seed + index)),
+                   "steps": int(params.get("steps", opt.ddim_steps)),
+                   "scale": float(params.get("scale", opt.scale)),
+                   "H": int(params.get("H", opt.H)),
+                   "W": int(params.get("W", opt.W))}
+
+
+def group_jobs(jobs, batch_size):
+    """
+    batches jobs which can be sampled together (same size, steps and
+    scale), a batch is yielded as soon as it is full and the rest at the end
+    """
+    pending = {}
+    for job in jobs:
+        key = (job["H"], job["W"], job["steps"], job["scale"])
+        group = pending.setdefault(key, [])
+        group.append(job)
+        if len(group) == batch_size:
+            yield key, pending.pop(key)
+    yield from pending.items()
+
+
+# emphasis of a token in () or, divided by it, in []
+EMPHASIS = 1.1
+BRACKETS = {")": "(", "]": "["}
+
+PROMPT_TOKENS = re.compile(r"""
+    \\(?P<escaped>.)                          # \( \) \[ \] \: are literal
+  | (?P<open>[(\[])
+  | :\s*(?P<emphasis>[+-]?(?:\d+\.?\d*|\.\d+))\s*\)  # (text:1.5)
+  | (?P<close>[)\]])
+  | (?P<colon>:)
+  | (?P<text>[^\\()\[\]:]+|\\)
+""", re.VERBOSE | re.DOTALL)
+
+
+def parse_weight(text):
+    """weight after the colon ending a sub-prompt and the rest of text"""
+    value, _, rest = text.partition(" ")
+    if not value:
+        return 1.0, rest
+    try:
+        return float(value), rest
+    except ValueError:
+        print(f"Warning: '{value}' is not a value, are you missing a space?")
+        return 1.0, rest
+
+
+def parse_prompt(text):
+    """
+    splits a prompt into weighted sub-prompts, "picture of:1 small:0.5 cat"
+    are 3 sub-prompts weighted 1, 0.5 and 1. Within a sub-prompt "(word)"
+    emphasizes word by EMPHASIS, "((word))" by EMPHASIS**2, "[word]" weakens
+    it and "(word:1.5)" sets its emphasis. Returns [(runs, weight)] with
+    runs [(text, emphasis)] of every sub-prompt.
+    """
+    parts = []
+    runs = []
+    stack = [] # (bracket, index of the first run inside it)
+
+    def emphasize(start, factor):
+        for run in runs[start:]:
+            run[1] *= factor
+
+    def end_part(weight):
+        while stack:
+            bracket, start = stack.pop()
+            emphasize(start, EMPHASIS if bracket == "(" else 1 / EMPHASIS)
+        merged = []
+        for text, emphasis in runs:
+            if merged and merged[-1][1] == emphasis:
+                merged[-1] = (merged[-1][0] + text, emphasis)
+            elif text:
+                merged.append((text, emphasis))
+        if merged:
+            parts.append((merged, weight))
+        runs.clear()
+
+    pos = 0
+    while pos < len(text):
+        match = PROMPT_TOKENS.match(text, pos)
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == "open":
+            stack.append((match.group(), len(runs)))
+        elif kind == "emphasis" and stack and stack[-1][0] == "(":
+            emphasize(stack.pop()[1], float(match.group("emphasis")))
+        elif kind == "close" and stack and stack[-1][0] == BRACKETS[match.group()]:
+            emphasize(stack.pop()[1], EMPHASIS if match.group() == ")" else 1 / EMPHASIS)
+        elif kind == "colon" and not stack:
+            weight, rest = parse_weight(text[pos:])
+            end_part(weight)
+            text, pos = rest, 0
+        else:
+            runs.append([match.group("escaped") or match.group(), 1.0])
+    end_part(1.0)
+    return parts
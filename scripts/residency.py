@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import torch
+from offload import Unit, make_backend
+
+
+class _Entry:
+    def __init__(self, units):
+        self.units = units
+        self.nbytes = sum(unit.nbytes for unit in units)
+        self.buffers = None
+        self.ready = []
+        self.users = 0
+        self.pinned = False
+        self.last_used = 0
+
+
+class ResidencyManager:
+    """
+    Keeps track of which sub-models (UNet, CondStage, FirstStage) are on
+    the device.
+
+    Every registered model is packed once into pinned host memory which
+    stays its master copy, so evicting it needs no copy back. Uploads run
+    on a side stream and the model's users wait on their completion event
+    right before using it. With a budget, models not in use stay on the
+    device as long as everything fits and the least recently used one is
+    evicted first, without one only models in use are kept there.
+
+    On a CPU device every call is a no-op.
+    """
+    def __init__(self, device, budget=None, backend=None, history=1000):
+        self.enabled = torch.device(device).type != "cpu"
+        self.budget = budget
+        self.backend = backend
+        if backend is None and self.enabled:
+            self.backend = make_backend(device)
+        self.entries = {}
+        self.lock = threading.RLock()
+        self.clock = 0
+        self.transfers = deque(maxlen=history)
+
+    def register(self, name, *modules):
+        if self.enabled:
+            self.entries[name] = _Entry([Unit(module, self.backend) for module in modules])
+
+    def resident(self):
+        return [name for name, entry in self.entries.items() if entry.buffers is not None]
+
+    def used(self):
+        return sum(entry.nbytes for entry in self.entries.values() if entry.buffers is not None)
+
+    def _evict(self, name):
+        entry = self.entries[name]
+        start = time.perf_counter()
+        for unit in entry.units:
+            unit.point_to(unit.host)
+        entry.buffers = None
+        entry.ready = []
+        self.transfers.append({"name": name,
+                               "kind": "evict",
+                               "bytes": entry.nbytes,
+                               "ms": (time.perf_counter() - start) * 1000})
+
+    def _make_room(self, name):
+        idle = [other for other, entry in self.entries.items()
+                if other != name and entry.buffers is not None
+                and entry.users == 0 and not entry.pinned]
+        idle.sort(key=lambda other: self.entries[other].last_used)
+        needed = self.entries[name].nbytes
+        for other in idle:
+            if self.budget is not None and self.used() + needed <= self.budget:
+                break
+            self._evict(other)
+
+    def load(self, name):
+        """starts uploading model name unless it is on the device already"""
+        if name not in self.entries:
+            return
+        with self.lock:
+            entry = self.entries[name]
+            if entry.buffers is not None:
+                return
+            self._make_room(name)
+            entry.buffers = []
+            for unit in entry.units:
+                buffer = self.backend.alloc(unit.nbytes)
+                start, done = self.backend.upload_timed(buffer, unit.host)
+                entry.buffers.append(buffer)
+                entry.ready.append(done)
+                self.transfers.append({"name": name,
+                                       "kind": "upload",
+                                       "bytes": unit.nbytes,
+                                       "events": (start, done)})
+
+    def acquire(self, name):
+        """makes model name usable on the device until release(name)"""
+        if name not in self.entries:
+            return
+        with self.lock:
+            self.load(name)
+            entry = self.entries[name]
+            for event in entry.ready:
+                if event is not None:
+                    self.backend.wait(event)
+            entry.ready = []
+            for unit, buffer in zip(entry.units, entry.buffers):
+                unit.point_to(buffer)
+            entry.users += 1
+
+    def release(self, name):
+        if name not in self.entries:
+            return
+        with self.lock:
+            entry = self.entries[name]
+            entry.users -= 1
+            self.clock += 1
+            entry.last_used = self.clock
+            if entry.users == 0 and not entry.pinned:
+                if self.budget is None:
+                    self._evict(name)
+                else:
+                    # idle models keep their device copy, but outside of
+                    # use() they can still run from the host copy
+                    for unit in entry.units:
+                        unit.point_to(unit.host)
+
+    @contextmanager
+    def use(self, name):
+        self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def pin(self, name):
+        """keeps model name on the device for good"""
+        if name in self.entries:
+            self.acquire(name)
+            self.entries[name].pinned = True
+
+    def timings(self):
+        """per transfer timings, waits for uploads still running"""
+        with self.lock:
+            for transfer in self.transfers:
+                if "events" in transfer:
+                    transfer["ms"] = self.backend.elapsed_ms(*transfer.pop("events"))
+            return [dict(transfer) for transfer in self.transfers]
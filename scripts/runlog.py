@@ -0,0 +1,169 @@
+"""
+Journal of runs, one JSON object per line in logs/runs.jsonl.
+
+A run is appended as one line when it ends, with one write on a file
+opened in append mode, so logging costs the same however long the
+journal is and processes sharing it need no lock (on local POSIX file
+systems the kernel keeps such appends whole). Every line has the same
+fields:
+
+    version   schema version of the line
+    id        unique id of the run
+    kind      txt2img or img2img
+    started   unix time the run started at
+    ended     unix time the run ended at
+    status    done, cancelled or failed
+    error     why the run didn't finish, otherwise null
+    params    options of the run
+    seeds     seed of every image
+    outputs   path of every saved image, null for images which weren't saved
+    scores    aesthetic score of every image, null without --aesthetic-threshold
+    timings   seconds spent in each stage (load, conditioning, sampling, ...)
+
+python scripts/runlog.py --kind txt2img --last 10
+"""
+import argparse, json, os, time, uuid
+from contextlib import contextmanager
+from cancel import Cancelled
+
+
+JOURNAL = "logs/runs.jsonl"
+VERSION = 1
+
+
+def append(record, path=JOURNAL):
+    """appends record as one line of the journal at path"""
+    line = (json.dumps(record, default=str) + "\n").encode("utf-8")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class Run:
+    """
+    record of one run, used as a context manager which appends it to the
+    journal when the run ends, also when it fails
+    """
+    def __init__(self, kind, params, path=JOURNAL):
+        self.path = path
+        self.record = {
+            "version": VERSION,
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "started": time.time(),
+            "ended": None,
+            "status": None,
+            "error": None,
+            "params": dict(params),
+            "seeds": [],
+            "outputs": [],
+            "scores": [],
+            "timings": {},
+        }
+
+    @contextmanager
+    def stage(self, name):
+        """adds the time spent in the block to the timing of stage name"""
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings = self.record["timings"]
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - tic
+
+    def output(self, seed, path, score=None):
+        self.record["seeds"].append(seed)
+        self.record["outputs"].append(path)
+        self.record["scores"].append(score)
+
+    def stop(self, status, error=None):
+        self.record["status"] = status
+        self.record["error"] = None if error is None else str(error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.record["status"] is None:
+            if exc_type is None:
+                self.stop("done")
+            else:
+                # a generator closed by its consumer ends with GeneratorExit
+                cancelled = issubclass(exc_type, (Cancelled, GeneratorExit, KeyboardInterrupt))
+                self.stop("cancelled" if cancelled else "failed", exc)
+        self.record["ended"] = time.time()
+        append(self.record, self.path)
+        return False
+
+
+def read_runs(path=JOURNAL, kind=None, status=None, since=None, **params):
+    """
+    yields the runs of the journal at path, oldest first, optionally only
+    those of a kind or status, started after the unix time since or with
+    the given params, e.g. read_runs(sampler="euler", H=768). A line cut
+    off by a crash is skipped.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if kind is not None and record["kind"] != kind:
+                continue
+            if status is not None and record["status"] != status:
+                continue
+            if since is not None and record["started"] < since:
+                continue
+            if any(record["params"].get(key) != value for key, value in params.items()):
+                continue
+            yield record
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--journal",
+    type=str,
+    default=JOURNAL,
+    help="path of the journal",
+)
+parser.add_argument(
+    "--kind",
+    type=str,
+    choices=["txt2img", "img2img"],
+    default=None,
+    help="only list runs of this kind",
+)
+parser.add_argument(
+    "--status",
+    type=str,
+    choices=["done", "cancelled", "failed"],
+    default=None,
+    help="only list runs which ended like this",
+)
+parser.add_argument(
+    "--last",
+    type=int,
+    default=20,
+    help="number of runs listed, the most recent ones",
+)
+
+
+def main():
+    opt = parser.parse_args()
+    runs = list(read_runs(opt.journal, kind=opt.kind, status=opt.status))[-opt.last:]
+    for record in runs:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["started"]))
+        timings = " ".join(f"{name}={seconds:.1f}s" for name, seconds in record["timings"].items())
+        saved = sum(path is not None for path in record["outputs"])
+        print(f"{started} {record['kind']} {record['status']:>9} {saved}/{len(record['outputs'])} images "
+              f"{timings} {record['params'].get('prompt')!r}")
+
+
+if __name__ == "__main__":
+    main()
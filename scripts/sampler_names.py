@@ -0,0 +1,12 @@
+"""
+Names of the k-diffusion samplers and noise schedules of samplers.py.
+
+Kept free of torch so the command line scripts can list them as choices
+without paying for the import before the options are checked. Solvers
+registered with samplers.register_sampler run through run_sampler under
+any name, listing them here only offers them on the command line.
+"""
+
+SAMPLER_NAMES = ["euler", "euler_a", "heun", "dpm2", "dpm2_a", "lms", "dpmpp_2m", "dpmpp_3m", "unipc"]
+
+SCHEDULES = ["linear", "karras", "exponential"]
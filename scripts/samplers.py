@@ -1,7 +1,22 @@
-from scipy import integrate
+import functools, hashlib, inspect, math, threading
+from collections import OrderedDict
 import torch
 from tqdm.auto import trange, tqdm
 import torch.nn as nn
+from ldm.modules.attention import cfg_conditioning
+
+
+# name -> fn(model, x, sigmas, extra_args=None, callback=None, disable=None),
+# samplers drawing noise also take noise_sampler, a replacement of torch.randn_like
+SAMPLERS = {}
+
+
+def register_sampler(name):
+    """decorator making a k-diffusion style solver available as sampler name"""
+    def wrap(fn):
+        SAMPLERS[name] = fn
+        return fn
+    return wrap
 
 
 def append_zero(x):
@@ -23,6 +38,19 @@ def get_ancestral_step(sigma_from, sigma_to):
     return sigma_down, sigma_up
 
 
+def get_sigmas_karras(n, sigma_min, sigma_max, rho=7., device='cpu'):
+    """Constructs the noise schedule of Karras et al. (2022)."""
+    ramp = torch.linspace(0, 1, n, device=device)
+    min_inv_rho = sigma_min ** (1 / rho)
+    max_inv_rho = sigma_max ** (1 / rho)
+    return (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
+
+
+def get_sigmas_exponential(n, sigma_min, sigma_max, device='cpu'):
+    """Constructs an exponential noise schedule."""
+    return torch.linspace(math.log(sigma_max), math.log(sigma_min), n, device=device).exp()
+
+
 class DiscreteSchedule(nn.Module):
     """A mapping between continuous noise levels (sigmas) and a list of discrete noise
     levels."""
@@ -30,31 +58,50 @@ class DiscreteSchedule(nn.Module):
     def __init__(self, sigmas, quantize):
         super().__init__()
         self.register_buffer('sigmas', sigmas)
+        self.register_buffer('log_sigmas', sigmas.log())
         self.quantize = quantize
-
-    def get_sigmas(self, n=None):
+        self.cache = {}
+
+    def get_sigmas(self, n=None, kind="linear"):
+        """
+        n noise levels from the largest to the smallest plus a final zero,
+        linear in t or spaced like Karras et al. (2022) or evenly in log
+        sigma. Schedules are cached and shared, so don't modify them.
+        """
         if n is None:
             return append_zero(self.sigmas.flip(0))
-        t_max = len(self.sigmas) - 1
-        t = torch.linspace(t_max, 0, n, device=self.sigmas.device)
-        return append_zero(self.t_to_sigma(t))
+        if (n, kind) not in self.cache:
+            if kind == "linear":
+                t_max = len(self.sigmas) - 1
+                t = torch.linspace(t_max, 0, n, device=self.sigmas.device)
+                sigmas = self.t_to_sigma(t)
+            elif kind == "karras":
+                sigmas = get_sigmas_karras(n, self.sigmas[0].item(), self.sigmas[-1].item(), device=self.sigmas.device)
+            elif kind == "exponential":
+                sigmas = get_sigmas_exponential(n, self.sigmas[0].item(), self.sigmas[-1].item(), device=self.sigmas.device)
+            else:
+                raise ValueError(f"unknown schedule '{kind}'")
+            self.cache[(n, kind)] = append_zero(sigmas)
+        return self.cache[(n, kind)]
 
     def sigma_to_t(self, sigma, quantize=None):
         quantize = self.quantize if quantize is None else quantize
-        dists = torch.abs(sigma - self.sigmas[:, None])
-        if quantize:
-            return torch.argmin(dists, dim=0).view(sigma.shape)
-        low_idx, high_idx = torch.sort(torch.topk(dists, dim=0, k=2, largest=False).indices, dim=0)[0]
+        flat = sigma.reshape(-1)
+        # log sigmas grow with t, the neighbours are found by bisection and
+        # interpolated in sigma like the nearest two always were
+        high_idx = torch.searchsorted(self.log_sigmas, flat.log().contiguous()).clamp(1, len(self.log_sigmas) - 1)
+        low_idx = high_idx - 1
         low, high = self.sigmas[low_idx], self.sigmas[high_idx]
-        w = (low - sigma) / (low - high)
+        w = (low - flat) / (low - high)
         w = w.clamp(0, 1)
+        if quantize:
+            return torch.where(w < 0.5, low_idx, high_idx).view(sigma.shape)
         t = (1 - w) * low_idx + w * high_idx
         return t.view(sigma.shape)
 
     def t_to_sigma(self, t):
         t = t.float()
         low_idx, high_idx, w = t.floor().long(), t.ceil().long(), t.frac()
-        # print(low_idx, high_idx, w )
         return (1 - w) * self.sigmas[low_idx] + w * self.sigmas[high_idx]
 
 
@@ -89,6 +136,108 @@ class CompVisDenoiser(DiscreteEpsDDPMDenoiser):
         return self.inner_model.apply_model(*args, **kwargs)
 
 
+class BatchNoise:
+    """
+    gaussian noise for a batch from one torch.Generator per sample, seeded
+    seed, seed + 1, ... or with a list of seeds one each. Any image can be
+    reproduced at any batch size and jobs sampling concurrently don't
+    share random state.
+    """
+
+    def __init__(self, seed, batch_size, device):
+        if isinstance(seed, (list, tuple)):
+            self.seeds = list(seed)
+        else:
+            self.seeds = [seed + i for i in range(batch_size)]
+        self.device = torch.device(device)
+        self.generators = [torch.Generator(device=self.device).manual_seed(s) for s in self.seeds]
+
+    def randn(self, shape, dtype=torch.float32):
+        """noise of shape (batch_size, *shape)"""
+        out = torch.empty((len(self.generators), *shape), dtype=dtype, device=self.device)
+        for sample, generator in zip(out, self.generators):
+            torch.randn(sample.shape, generator=generator, dtype=dtype, device=self.device, out=sample)
+        return out
+
+    def __call__(self, x):
+        return self.randn(x.shape[1:], x.dtype)
+
+
+_schedules = OrderedDict()
+_schedules_lock = threading.Lock()
+
+
+def compvis_schedule(alphas_cumprod, max_entries=4):
+    """
+    CompVisDenoiser of an alphas_cumprod tensor, built once and shared by
+    every run. Keyed on the device, dtype and content of the tensor, the
+    callers pass a fresh copy of it every run.
+    """
+    content = hashlib.sha1(alphas_cumprod.detach().cpu().numpy().tobytes()).hexdigest()
+    key = (str(alphas_cumprod.device), alphas_cumprod.dtype, content)
+    with _schedules_lock:
+        if key in _schedules:
+            _schedules.move_to_end(key)
+            return _schedules[key]
+        schedule = _schedules[key] = CompVisDenoiser(alphas_cumprod)
+        while len(_schedules) > max_entries:
+            _schedules.popitem(last=False)
+        return schedule
+
+
+class CFGDenoiser(nn.Module):
+    """
+    classifier free guidance around a CompVis model. The unconditional and
+    conditional halves of a step run as one batch, the conditioning of both
+    is concatenated once per run and the batched input and noise levels
+    are buffers every step writes into.
+    """
+
+    def __init__(self, model, alphas_cumprod, cond, uncond=None, scale=1.):
+        super().__init__()
+        self.inner_model = model
+        self.schedule = compvis_schedule(alphas_cumprod)
+        self.scale = scale
+        self.guided = uncond is not None
+        self.cond = cfg_conditioning(uncond, cond) if self.guided else cond
+        self.x_in = None
+        self.sigma_in = None
+
+    def _inputs(self, x, sigma):
+        copies = 2 if self.guided else 1
+        shape = (copies * x.shape[0],) + tuple(x.shape[1:])
+        if self.x_in is None or self.x_in.shape != shape or self.x_in.dtype != x.dtype:
+            self.x_in = x.new_empty(shape)
+            self.sigma_in = sigma.new_empty(shape[:1])
+        for x_half, sigma_half in zip(self.x_in.chunk(copies), self.sigma_in.chunk(copies)):
+            x_half.copy_(x)
+            sigma_half.copy_(sigma)
+        return self.x_in, self.sigma_in
+
+    def forward(self, x, sigma):
+        x_in, sigma_in = self._inputs(x, sigma)
+        c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in self.schedule.get_scalings(sigma_in)]
+        eps = self.inner_model.apply_model(x_in * c_in, self.schedule.sigma_to_t(sigma_in), self.cond)
+        # the UNet output is fp16 under autocast, the samplers work in fp32
+        denoised = x_in + eps.float() * c_out
+        if not self.guided:
+            return denoised
+        uncond, cond = denoised.chunk(2)
+        return uncond.lerp_(cond, self.scale)
+
+
+def run_sampler(name, model, alphas_cumprod, x, steps, cond, uncond=None, scale=1., callback=None, disable=None,
+                schedule="linear", noise_sampler=None):
+    """denoises unit variance noise x in steps steps with the registered sampler name"""
+    denoiser = CFGDenoiser(model, alphas_cumprod, cond, uncond, scale)
+    sigmas = denoiser.schedule.get_sigmas(steps, schedule)
+    fn = SAMPLERS[name]
+    kwargs = {}
+    if noise_sampler is not None and "noise_sampler" in inspect.signature(fn).parameters:
+        kwargs["noise_sampler"] = noise_sampler
+    return fn(denoiser, x * sigmas[0], sigmas, callback=callback, disable=disable, **kwargs)
+
+
 def to_d(x, sigma, denoised):
     """Converts a denoiser output to a Karras ODE derivative."""
     return (x - denoised) / append_dims(sigma, x.ndim)
@@ -102,16 +251,18 @@ def get_ancestral_step(sigma_from, sigma_to):
     return sigma_down, sigma_up
 
 
+@register_sampler("euler")
 @torch.no_grad()
-def sample_euler(model, x, sigmas, extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1.):
+def sample_euler(model, x, sigmas, extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1., noise_sampler=None):
     """Implements Algorithm 2 (Euler steps) from Karras et al. (2022)."""
     extra_args = {} if extra_args is None else extra_args
+    noise_sampler = torch.randn_like if noise_sampler is None else noise_sampler
     s_in = x.new_ones([x.shape[0]])
     for i in trange(len(sigmas) - 1, disable=disable):
         gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-        eps = torch.randn_like(x) * s_noise
         sigma_hat = sigmas[i] * (gamma + 1)
         if gamma > 0:
+            eps = noise_sampler(x) * s_noise
             x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
         denoised = model(x, sigma_hat * s_in, **extra_args)
         d = to_d(x, sigma_hat, denoised)
@@ -124,10 +275,12 @@ def sample_euler(model, x, sigmas, extra_args=None, callback=None, disable=None,
 
 
 
+@register_sampler("euler_a")
 @torch.no_grad()
-def sample_euler_ancestral(model, x, sigmas, extra_args=None, callback=None, disable=None):
+def sample_euler_ancestral(model, x, sigmas, extra_args=None, callback=None, disable=None, noise_sampler=None):
     """Ancestral sampling with Euler method steps."""
     extra_args = {} if extra_args is None else extra_args
+    noise_sampler = torch.randn_like if noise_sampler is None else noise_sampler
     s_in = x.new_ones([x.shape[0]])
     for i in trange(len(sigmas) - 1, disable=disable):
         denoised = model(x, sigmas[i] * s_in, **extra_args)
@@ -138,20 +291,22 @@ def sample_euler_ancestral(model, x, sigmas, extra_args=None, callback=None, dis
         # Euler method
         dt = sigma_down - sigmas[i]
         x = x + d * dt
-        x = x + torch.randn_like(x) * sigma_up
+        x = x + noise_sampler(x) * sigma_up
     return x
 
 
+@register_sampler("heun")
 @torch.no_grad()
-def sample_heun(model, x, sigmas, extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1.):
+def sample_heun(model, x, sigmas, extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1., noise_sampler=None):
     """Implements Algorithm 2 (Heun steps) from Karras et al. (2022)."""
     extra_args = {} if extra_args is None else extra_args
+    noise_sampler = torch.randn_like if noise_sampler is None else noise_sampler
     s_in = x.new_ones([x.shape[0]])
     for i in trange(len(sigmas) - 1, disable=disable):
         gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-        eps = torch.randn_like(x) * s_noise
         sigma_hat = sigmas[i] * (gamma + 1)
         if gamma > 0:
+            eps = noise_sampler(x) * s_noise
             x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
         denoised = model(x, sigma_hat * s_in, **extra_args)
         d = to_d(x, sigma_hat, denoised)
@@ -171,16 +326,18 @@ def sample_heun(model, x, sigmas, extra_args=None, callback=None, disable=None,
     return x
 
 
+@register_sampler("dpm2")
 @torch.no_grad()
-def sample_dpm_2(model, x, sigmas, extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1.):
+def sample_dpm_2(model, x, sigmas, extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1., noise_sampler=None):
     """A sampler inspired by DPM-Solver-2 and Algorithm 2 from Karras et al. (2022)."""
     extra_args = {} if extra_args is None else extra_args
+    noise_sampler = torch.randn_like if noise_sampler is None else noise_sampler
     s_in = x.new_ones([x.shape[0]])
     for i in trange(len(sigmas) - 1, disable=disable):
         gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-        eps = torch.randn_like(x) * s_noise
         sigma_hat = sigmas[i] * (gamma + 1)
         if gamma > 0:
+            eps = noise_sampler(x) * s_noise
             x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
         denoised = model(x, sigma_hat * s_in, **extra_args)
         d = to_d(x, sigma_hat, denoised)
@@ -197,10 +354,12 @@ def sample_dpm_2(model, x, sigmas, extra_args=None, callback=None, disable=None,
     return x
 
 
+@register_sampler("dpm2_a")
 @torch.no_grad()
-def sample_dpm_2_ancestral(model, x, sigmas, extra_args=None, callback=None, disable=None):
+def sample_dpm_2_ancestral(model, x, sigmas, extra_args=None, callback=None, disable=None, noise_sampler=None):
     """Ancestral sampling with DPM-Solver inspired second-order steps."""
     extra_args = {} if extra_args is None else extra_args
+    noise_sampler = torch.randn_like if noise_sampler is None else noise_sampler
     s_in = x.new_ones([x.shape[0]])
     for i in trange(len(sigmas) - 1, disable=disable):
         denoised = model(x, sigmas[i] * s_in, **extra_args)
@@ -216,28 +375,43 @@ def sample_dpm_2_ancestral(model, x, sigmas, extra_args=None, callback=None, dis
         denoised_2 = model(x_2, sigma_mid * s_in, **extra_args)
         d_2 = to_d(x_2, sigma_mid, denoised_2)
         x = x + d_2 * dt_2
-        x = x + torch.randn_like(x) * sigma_up
+        x = x + noise_sampler(x) * sigma_up
     return x
 
 
 def linear_multistep_coeff(order, t, i, j):
+    """
+    integral over [t[i], t[i + 1]] of the Lagrange basis polynomial of node
+    t[i - j] on the nodes t[i], ..., t[i - order + 1], in closed form
+    """
     if order - 1 > i:
         raise ValueError(f'Order {order} too high for step {i}')
-    def fn(tau):
-        prod = 1.
-        for k in range(order):
-            if j == k:
-                continue
-            prod *= (tau - t[i - k]) / (t[i - j] - t[i - k])
-        return prod
-    return integrate.quad(fn, t[i], t[i + 1], epsrel=1e-4)[0]
-
-
+    nodes = [float(t[i - k]) for k in range(order)]
+    # polynomial coefficients, lowest degree first
+    poly = [1.]
+    for k, node in enumerate(nodes):
+        if k == j:
+            continue
+        denom = nodes[j] - node
+        poly = [(low - node * high) / denom for low, high in zip([0.] + poly, poly + [0.])]
+    a, b = float(t[i]), float(t[i + 1])
+    return sum(c * (b ** (d + 1) - a ** (d + 1)) / (d + 1) for d, c in enumerate(poly))
+
+
+@functools.lru_cache(maxsize=32)
+def lms_coefficients(sigmas, order):
+    """per step coefficients of the current and previous derivatives, sigmas is a tuple"""
+    return [[linear_multistep_coeff(min(i + 1, order), sigmas, i, j) for j in range(min(i + 1, order))]
+            for i in range(len(sigmas) - 1)]
+
+
+@register_sampler("lms")
 @torch.no_grad()
 def sample_lms(model, x, sigmas, extra_args=None, callback=None, disable=None, order=4):
     extra_args = {} if extra_args is None else extra_args
     s_in = x.new_ones([x.shape[0]])
     ds = []
+    coeffs = lms_coefficients(tuple(sigmas.tolist()), order)
     for i in trange(len(sigmas) - 1, disable=disable):
         denoised = model(x, sigmas[i] * s_in, **extra_args)
         d = to_d(x, sigmas[i], denoised)
@@ -246,7 +420,136 @@ def sample_lms(model, x, sigmas, extra_args=None, callback=None, disable=None, o
             ds.pop(0)
         if callback is not None:
             callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
-        cur_order = min(i + 1, order)
-        coeffs = [linear_multistep_coeff(cur_order, sigmas.cpu(), i, j) for j in range(cur_order)]
-        x = x + sum(coeff * d for coeff, d in zip(coeffs, reversed(ds)))
+        x = x + sum(coeff * d for coeff, d in zip(coeffs[i], reversed(ds)))
+    return x
+
+
+@register_sampler("dpmpp_2m")
+@torch.no_grad()
+def sample_dpmpp_2m(model, x, sigmas, extra_args=None, callback=None, disable=None):
+    """DPM-Solver++(2M), Lu et al. (2022)."""
+    extra_args = {} if extra_args is None else extra_args
+    s_in = x.new_ones([x.shape[0]])
+    sigma_fn = lambda t: t.neg().exp()
+    t_fn = lambda sigma: sigma.log().neg()
+    old_denoised = None
+    for i in trange(len(sigmas) - 1, disable=disable):
+        denoised = model(x, sigmas[i] * s_in, **extra_args)
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+        t, t_next = t_fn(sigmas[i]), t_fn(sigmas[i + 1])
+        h = t_next - t
+        if old_denoised is not None and sigmas[i + 1] > 0:
+            r = (t - t_fn(sigmas[i - 1])) / h
+            denoised_d = (1 + 1 / (2 * r)) * denoised - (1 / (2 * r)) * old_denoised
+        else:
+            denoised_d = denoised
+        x = (sigma_fn(t_next) / sigma_fn(t)) * x - (-h).expm1() * denoised_d
+        old_denoised = denoised
+    return x
+
+
+@register_sampler("dpmpp_3m")
+@torch.no_grad()
+def sample_dpmpp_3m(model, x, sigmas, extra_args=None, callback=None, disable=None):
+    """DPM-Solver++(3M), the third order multistep variant of Lu et al. (2022)."""
+    extra_args = {} if extra_args is None else extra_args
+    s_in = x.new_ones([x.shape[0]])
+    denoised_1, denoised_2 = None, None
+    h_1, h_2 = None, None
+    for i in trange(len(sigmas) - 1, disable=disable):
+        denoised = model(x, sigmas[i] * s_in, **extra_args)
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+        if sigmas[i + 1] == 0:
+            # Denoising step
+            x = denoised
+        else:
+            h = sigmas[i].log() - sigmas[i + 1].log()
+            x = torch.exp(-h) * x - (-h).expm1() * denoised
+            phi_2 = (-h).expm1() / h + 1
+            if h_2 is not None:
+                r0 = h_1 / h
+                r1 = h_2 / h
+                d1_0 = (denoised - denoised_1) / r0
+                d1_1 = (denoised_1 - denoised_2) / r1
+                d1 = d1_0 + (d1_0 - d1_1) * r0 / (r0 + r1)
+                d2 = (d1_0 - d1_1) / (r0 + r1)
+                phi_3 = phi_2 / h - 0.5
+                x = x + phi_2 * d1 - phi_3 * d2
+            elif h_1 is not None:
+                x = x + phi_2 * (denoised - denoised_1) / (h_1 / h)
+            h_1, h_2 = h, h_1
+        denoised_1, denoised_2 = denoised, denoised_1
+    return x
+
+
+def unipc_coefficients(rks, h, corrector):
+    """weights of the model output differences of a UniPC-bh2 step"""
+    hh = -h
+    h_phi_1 = math.expm1(hh)
+    h_phi_k = h_phi_1 / hh - 1
+    factorial = 1
+    b = []
+    for i in range(1, len(rks) + 1):
+        b.append(h_phi_k * factorial / h_phi_1)
+        factorial *= i + 1
+        h_phi_k = h_phi_k / hh - 1 / factorial
+    R = torch.tensor([[rk ** k for rk in rks] for k in range(len(rks))], dtype=torch.float64)
+    b = torch.tensor(b, dtype=torch.float64)
+    if corrector:
+        return [0.5] if len(rks) == 1 else torch.linalg.solve(R, b).tolist()
+    if len(rks) <= 2:
+        return [0.5] * (len(rks) - 1)
+    return torch.linalg.solve(R[:-1, :-1], b[:-1]).tolist()
+
+
+def unipc_step(x, history, lambdas, lambda_t, denoised_t=None):
+    """
+    UniP step (or UniC step when given denoised_t, the model output at
+    lambda_t) from x at lambdas[-1] to lambda_t, history[k] is the model
+    output at lambdas[k]
+    """
+    m0, lambda_s0 = history[-1], lambdas[-1]
+    h = lambda_t - lambda_s0
+    rks, diffs = [], []
+    for m, lambda_s in zip(history[-2::-1], lambdas[-2::-1]):
+        rk = (lambda_s - lambda_s0) / h
+        rks.append(rk)
+        diffs.append((m - m0) / rk)
+    rks.append(1.)
+    rhos = unipc_coefficients(rks, h, corrector=denoised_t is not None)
+    h_phi_1 = math.expm1(-h)
+    res = sum(rho * d for rho, d in zip(rhos, diffs))
+    if denoised_t is not None:
+        res = res + rhos[-1] * (denoised_t - m0)
+    return math.exp(-h) * x - h_phi_1 * m0 - h_phi_1 * res
+
+
+@register_sampler("unipc")
+@torch.no_grad()
+def sample_unipc(model, x, sigmas, extra_args=None, callback=None, disable=None, order=2):
+    """UniPC with B(h) = e^h - 1 on the data prediction, Zhao et al. (2023)."""
+    extra_args = {} if extra_args is None else extra_args
+    s_in = x.new_ones([x.shape[0]])
+    # log-sigma steps as floats, the step coefficients never touch the device
+    lambdas = sigmas.log().neg().tolist()
+    history = []
+    cur_order = 0
+    x_last = None
+    for i in trange(len(sigmas) - 1, disable=disable):
+        denoised = model(x, sigmas[i] * s_in, **extra_args)
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+        if sigmas[i + 1] == 0:
+            # Denoising step
+            x = denoised
+            continue
+        if history:
+            # the corrector reuses this step's evaluation, so it costs no extra model call
+            x = unipc_step(x_last, history[-cur_order:], lambdas[i - cur_order:i], lambdas[i], denoised)
+        history = (history + [denoised])[-order:]
+        cur_order = min(order, len(history), len(sigmas) - 2 - i)
+        x_last = x
+        x = unipc_step(x, history[-cur_order:], lambdas[i + 1 - cur_order:i + 1], lambdas[i + 1])
     return x
@@ -0,0 +1,403 @@
+"""
+Long-lived generation worker.
+
+Loads UNet, CondStage and FirstStage once and then serves txt2img/img2img
+jobs over a local HTTP (or Unix socket) job API, so per-job latency is
+only sampling plus decoding.
+
+POST /txt2img or /img2img with a JSON object whose keys are the option
+names of the matching CLI (e.g. {"prompt": "dog", "ddim_steps": 30}). The
+response is streamed as JSON lines, one line per generated image.
+
+With --max_batch jobs sharing resolution and step count run concurrently
+and their UNet evaluations are batched together by BatchScheduler.
+
+Jobs with "preview_every" also stream {"step": ..., "preview": [...]}
+lines with approximate low resolution PNGs of the batch while sampling.
+
+The first line of every response is {"job": id}. DELETE /jobs/<id>
+cancels the job between two sampling steps, as does a "timeout" in
+seconds running out or the client going away.
+"""
+import argparse, base64, io, json, os, socketserver, threading, uuid
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import randint
+from pytorch_lightning import seed_everything
+from transformers import logging
+from batching import BatchScheduler
+from cancel import CancelToken, Cancelled
+from runlog import Run
+from pipeline import load_models, make_outpath, txt2img, img2img
+import txt2img as txt2img_cli
+import img2img as img2img_cli
+logging.set_verbosity_error()
+
+
+# options which decide how models are loaded, they can't change per job
+MODEL_OPTIONS = ("ckpt", "device", "precision", "unet_bs", "turbo", "unet_budget",
+                 "unet_policy", "vram_budget", "attention", "cond_cache")
+
+JOBS = {
+    "txt2img": (txt2img_cli, txt2img),
+    "img2img": (img2img_cli, img2img),
+}
+
+
+class JobError(Exception):
+    pass
+
+
+def job_options(parser, params):
+    """
+    builds an argparse namespace from JSON job parameters, applying the
+    same types, choices and defaults the CLI uses
+    """
+    actions = {action.dest: action for action in parser._actions}
+    opt = parser.parse_args([])
+    for key, value in params.items():
+        action = actions.get(key)
+        if action is None or key == "help":
+            raise JobError(f"unknown option '{key}'")
+        if value is not None and action.type is not None:
+            try:
+                value = action.type(value)
+            except (TypeError, ValueError):
+                raise JobError(f"invalid value for '{key}': {value!r}")
+        if action.choices is not None and value not in action.choices:
+            raise JobError(f"invalid choice for '{key}': {value!r}")
+        setattr(opt, key, value)
+    return opt
+
+
+def job_key(kind, job):
+    """
+    jobs with equal keys share the sampling schedule and the devices the
+    first stage model runs on, so they may run together
+    """
+    return (kind, job.H, job.W, job.ddim_steps, job.ddim_eta, job.decode_device)
+
+
+class Worker:
+    """
+    owns the resident models and runs jobs on them, one at a time or
+    concurrently through a BatchScheduler
+    """
+    def __init__(self, opt):
+        self.opt = opt
+        self.models = load_models(opt.ckpt,
+                                  opt.device,
+                                  opt.precision,
+                                  unet_bs=opt.unet_bs,
+                                  turbo=opt.turbo,
+                                  unet_budget=opt.unet_budget,
+                                  unet_policy=opt.unet_policy,
+                                  vram_budget=opt.vram_budget,
+                                  attention=opt.attention,
+                                  cond_cache_dir=opt.cond_cache)
+        self.scheduler = None
+        if opt.max_batch > 0:
+            model = self.models.model
+            self.scheduler = BatchScheduler(model._apply_model,
+                                            max_batch=opt.max_batch,
+                                            max_wait=opt.max_wait,
+                                            on_idle=model.free_offload)
+            model.batcher = self.scheduler
+            if opt.turbo:
+                self.models.residency.pin("unet")
+        self.gate = threading.Condition()
+        self.running = 0
+        self.running_key = None
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+
+    @contextmanager
+    def admit(self, key):
+        """waits until the job may run next to the ones already running"""
+        with self.gate:
+            while self.running and (self.scheduler is None or key != self.running_key):
+                self.gate.wait()
+            self.running += 1
+            self.running_key = key
+        try:
+            yield
+        finally:
+            with self.gate:
+                self.running -= 1
+                self.gate.notify_all()
+
+    def prepare(self, kind, params):
+        if kind not in JOBS:
+            raise JobError(f"unknown job type '{kind}'")
+        cli, _ = JOBS[kind]
+        for key in MODEL_OPTIONS:
+            if key in params and params[key] != getattr(self.opt, key):
+                raise JobError(f"option '{key}' is fixed when the server starts")
+        job = job_options(cli.parser, params)
+        for key in MODEL_OPTIONS:
+            setattr(job, key, getattr(self.opt, key))
+        try:
+            cli.check_options(job)
+        except Exception as e:
+            raise JobError(str(e))
+        if kind == "img2img" and (job.init_img is None or not os.path.isfile(job.init_img)):
+            raise JobError("option 'init_img' must point to an existing file")
+        if job.seed is None:
+            job.seed = randint(0, 1000000)
+        return job
+
+    @contextmanager
+    def track(self, cancel):
+        """makes cancel reachable by the id it yields while the job runs"""
+        job_id = uuid.uuid4().hex
+        with self.jobs_lock:
+            self.jobs[job_id] = cancel
+        try:
+            yield job_id
+        finally:
+            with self.jobs_lock:
+                del self.jobs[job_id]
+
+    def cancel(self, job_id):
+        with self.jobs_lock:
+            cancel = self.jobs.get(job_id)
+        if cancel is None:
+            return False
+        cancel.cancel()
+        return True
+
+    def run(self, kind, params, job, preview=None, cancel=None):
+        _, generate = JOBS[kind]
+        outpath = make_outpath(job)
+        with open(os.path.join(outpath, "prompt.txt"), "w") as prompt_file:
+            prompt_file.write(json.dumps(params))
+
+        scope = self.scheduler.job() if self.scheduler is not None else nullcontext()
+        with Run(kind, vars(job)) as run, self.admit(job_key(kind, job)), scope:
+            seed_everything(job.seed)
+            for seed, dest_path, score in generate(self.models, job, outpath, preview=preview, cancel=cancel,
+                                                   stage=run.stage):
+                run.output(seed, dest_path, score)
+                result = {"seed": seed}
+                if score is not None:
+                    result["score"] = score
+                if dest_path is None:
+                    # scored below the aesthetic threshold and never written
+                    result["rejected"] = True
+                    yield result
+                    continue
+                result["path"] = os.path.realpath(dest_path)
+                with open(dest_path, "rb") as f:
+                    result["image"] = base64.b64encode(f.read()).decode("ascii")
+                yield result
+
+
+def png_base64(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="png")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    worker = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_json(self, code, obj):
+        body = (json.dumps(obj) + "\n").encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/transfers":
+            residency = self.worker.models.residency
+            self.send_json(200, {"resident": residency.resident(),
+                                 "transfers": residency.timings()})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_DELETE(self):
+        prefix = "/jobs/"
+        if self.path.startswith(prefix) and self.worker.cancel(self.path[len(prefix):]):
+            self.send_json(200, {"cancelled": self.path[len(prefix):]})
+        else:
+            self.send_json(404, {"error": "no such job"})
+
+    def do_POST(self):
+        kind = self.path.strip("/")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(params, dict):
+                raise JobError("job must be a JSON object")
+            job = self.worker.prepare(kind, params)
+        except (JobError, ValueError) as e:
+            self.send_json(404 if kind not in JOBS else 400, {"error": str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        cancel = CancelToken(job.timeout)
+
+        def send(result):
+            try:
+                self.write_chunk((json.dumps(result) + "\n").encode("utf-8"))
+            except ConnectionError:
+                cancel.cancel("client disconnected")
+                raise
+
+        def preview(step, images):
+            send({"step": step, "preview": [png_base64(image) for image in images]})
+
+        with self.worker.track(cancel) as job_id:
+            try:
+                send({"job": job_id})
+                for result in self.worker.run(kind, params, job, preview=preview, cancel=cancel):
+                    send(result)
+            except Cancelled as e:
+                send({"error": str(e), "cancelled": True})
+            except ConnectionError:
+                return
+            except Exception as e:
+                send({"error": str(e)})
+        self.write_chunk(b"")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--host",
+    type=str,
+    default="127.0.0.1",
+    help="address to listen on",
+)
+parser.add_argument(
+    "--port",
+    type=int,
+    default=7861,
+    help="port to listen on",
+)
+parser.add_argument(
+    "--socket",
+    type=str,
+    default=None,
+    help="listen on this Unix socket instead of TCP",
+)
+parser.add_argument(
+    "--ckpt",
+    type=str,
+    help="path to checkpoint of model",
+    default=txt2img_cli.DEFAULT_CKPT,
+)
+parser.add_argument(
+    "--device",
+    type=str,
+    default="cuda",
+    help="specify GPU (cuda/cuda:0/cuda:1/...)",
+)
+parser.add_argument(
+    "--precision",
+    type=str,
+    help="evaluate at this precision",
+    choices=["full", "autocast"],
+    default="autocast"
+)
+parser.add_argument(
+    "--unet_bs",
+    type=int,
+    default=1,
+    help="Slightly reduces inference time at the expense of high VRAM (value > 1 not recommended )",
+)
+parser.add_argument(
+    "--turbo",
+    action="store_true",
+    help="Reduces inference time on the expense of 1GB VRAM",
+)
+parser.add_argument(
+    "--unet_budget",
+    type=int,
+    default=None,
+    help="without --turbo, MB of VRAM for UNet weights which are paged in block by block (default: half of the UNet)",
+)
+parser.add_argument(
+    "--unet_policy",
+    type=str,
+    choices=["lookahead", "lru"],
+    default="lookahead",
+    help="which UNet block is evicted when --unet_budget is exceeded",
+)
+parser.add_argument(
+    "--vram_budget",
+    type=int,
+    default=None,
+    help="MB of VRAM idle models may keep using (default: only the model in use stays on the GPU)",
+)
+parser.add_argument(
+    "--attention",
+    type=str,
+    choices=["auto", "naive", "sliced", "chunked", "sdp", "xformers"],
+    default="auto",
+    help="attention kernel of the UNet, auto picks the fastest one which fits into memory",
+)
+parser.add_argument(
+    "--cond-cache",
+    type=str,
+    help="directory where encoded prompts are persisted between runs",
+    default=None,
+)
+parser.add_argument(
+    "--max_batch",
+    type=int,
+    default=0,
+    help="batch UNet steps of concurrent jobs up to this many latents (0 runs jobs one at a time)",
+)
+parser.add_argument(
+    "--max_wait",
+    type=float,
+    default=0.02,
+    help="seconds a pending UNet step waits for other jobs to join its batch",
+)
+
+
+def main():
+    opt = parser.parse_args()
+    JobHandler.worker = Worker(opt)
+
+    if opt.socket is not None:
+        if os.path.exists(opt.socket):
+            os.remove(opt.socket)
+        httpd = UnixHTTPServer(opt.socket, JobHandler)
+        print(f"Serving jobs on {opt.socket}")
+    else:
+        httpd = ThreadingHTTPServer((opt.host, opt.port), JobHandler)
+        print(f"Serving jobs on http://{opt.host}:{opt.port}")
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if opt.socket is not None and os.path.exists(opt.socket):
+            os.remove(opt.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,9 @@
-import os
+import hashlib, os, threading
+from collections import OrderedDict
+import numpy as np
 import torch
 from torch.nn import functional as F, Module, Linear
-from torchvision import transforms
-from torchvision.transforms import functional as TF
 from PIL import Image
-from clip import clip
 
 
 class AestheticMeanPredictionLinearModel(Module):
@@ -17,28 +16,77 @@ class AestheticMeanPredictionLinearModel(Module):
         return self.linear(x)
 
 
-clip_model = clip.load("ViT-B/16",
-                       jit=False,
-                       device="cpu")[0]
-clip_model.eval().requires_grad_(False)
-normalize = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073],
-                                 std=[0.26862954, 0.26130258, 0.27577711])
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
 
-# 512 is embed dimension for ViT-B/16 CLIP
-aesthetic_model = AestheticMeanPredictionLinearModel(512)
-aesthetic_model_raw_path = os.path.join(os.path.dirname(__file__),
-                                        "simulacra_vit_b_16_linear.pth")
-aesthetic_model_raw = torch.load(aesthetic_model_raw_path)
-aesthetic_model.load_state_dict(aesthetic_model_raw)
-aesthetic_model = aesthetic_model.to("cpu")
+
+class AestheticScorer:
+    """
+    simulacra aesthetic score of decoded images. CLIP ViT-B/16 and the
+    linear head are only loaded when the first image is scored, images
+    are scored in batches and scores are remembered by image hash.
+    """
+    def __init__(self, device="cpu", cache_size=4096):
+        self.device = device
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.clip_model = None
+        self.aesthetic_model = None
+
+    def load(self):
+        if self.clip_model is not None:
+            return
+        from clip import clip
+        clip_model = clip.load("ViT-B/16", jit=False, device=self.device)[0]
+        clip_model.eval().requires_grad_(False)
+
+        # 512 is embed dimension for ViT-B/16 CLIP
+        aesthetic_model = AestheticMeanPredictionLinearModel(512)
+        aesthetic_model_raw_path = os.path.join(os.path.dirname(__file__),
+                                                "simulacra_vit_b_16_linear.pth")
+        aesthetic_model.load_state_dict(torch.load(aesthetic_model_raw_path, map_location="cpu"))
+        self.aesthetic_model = aesthetic_model.to(self.device)
+        self.clip_model = clip_model
+
+    def preprocess(self, images):
+        """uint8 (n, h, w, 3) images to normalized (n, 3, 224, 224) CLIP input"""
+        x = torch.from_numpy(np.ascontiguousarray(images)).to(self.device)
+        x = x.permute(0, 3, 1, 2).float() / 255
+        h, w = x.shape[2:]
+        scale = 224 / min(h, w)
+        size = (max(224, round(h * scale)), max(224, round(w * scale)))
+        x = F.interpolate(x, size=size, mode="bicubic", align_corners=False, antialias=True)
+        top, left = (size[0] - 224) // 2, (size[1] - 224) // 2
+        x = x[:, :, top:top + 224, left:left + 224].clamp(0, 1)
+        mean = x.new_tensor(CLIP_MEAN)[:, None, None]
+        std = x.new_tensor(CLIP_STD)[:, None, None]
+        return (x - mean) / std
+
+    @torch.no_grad()
+    def score(self, images):
+        """scores of a batch of uint8 (n, h, w, 3) images"""
+        keys = [hashlib.sha1(image.tobytes()).hexdigest() for image in images]
+        with self.lock:
+            missing = [i for i, key in enumerate(keys) if key not in self.cache]
+            if missing:
+                self.load()
+                x = self.preprocess(np.stack([images[i] for i in missing]))
+                latent = F.normalize(self.clip_model.encode_image(x).float(), dim=-1)
+                scores = self.aesthetic_model(latent)[:, 0].tolist()
+                for i, score in zip(missing, scores):
+                    self.cache[keys[i]] = score
+            for key in keys:
+                self.cache.move_to_end(key)
+            result = [self.cache[key] for key in keys]
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return result
+
+
+scorer = AestheticScorer()
 
 
 def judge(img_path):
-    img = Image.open(img_path).convert("RGB")
-    img = TF.resize(img, 224, transforms.InterpolationMode.LANCZOS)
-    img = TF.center_crop(img, (224,224))
-    img = TF.to_tensor(img).to("cpu")
-    img = normalize(img)
-    latent = F.normalize(clip_model.encode_image(img[None, ...]).float(),
-                         dim=-1)
-    return aesthetic_model(latent)
+    img = np.array(Image.open(img_path).convert("RGB"))
+    return scorer.score(img[None])[0]
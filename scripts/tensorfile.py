@@ -0,0 +1,135 @@
+"""
+Pickle free checkpoint format compatible with safetensors.
+
+File layout is an 8 byte little endian header size, a JSON header mapping
+tensor names to their dtype, shape and byte range and then the raw tensor
+data. save_file starts every tensor at a multiple of ALIGNMENT bytes so the
+memory-mapped views are aligned for every dtype, the padding in between
+isn't part of any byte range (the safetensors library itself only accepts
+files without such gaps, files written by it are read just the same).
+Reading needs no unpickling, so checkpoints in this format don't have
+to pass through safeloader, and the loader memory-maps the file so only
+the tensors a model asks for are paged in.
+"""
+import json
+import mmap
+import struct
+import torch
+
+
+DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+TORCH_DTYPES = {code: dtype for dtype, code in DTYPES.items()}
+
+# header and tensor data start at multiples of this, at least the largest element size
+ALIGNMENT = 8
+
+
+def is_tensorfile(path):
+    return str(path).endswith(".safetensors")
+
+
+def save_file(tensors, path, metadata=None):
+    """
+    writes a dict of tensors, in the order the dict yields them, so tensors
+    loaded together should be next to each other
+    """
+    header = {}
+    if metadata is not None:
+        header["__metadata__"] = {k: str(v) for k, v in metadata.items()}
+    offset = 0
+    for name, tensor in tensors.items():
+        if tensor.dtype not in DTYPES:
+            raise ValueError(f"tensor '{name}' has unsupported dtype {tensor.dtype}")
+        offset += -offset % ALIGNMENT
+        nbytes = tensor.element_size() * tensor.nelement()
+        header[name] = {
+            "dtype": DTYPES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % ALIGNMENT)
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        written = 0
+        for name, tensor in tensors.items():
+            begin, end = header[name]["data_offsets"]
+            f.write(b"\0" * (begin - written))
+            data = tensor.detach().to("cpu").contiguous()
+            if data.dtype == torch.bfloat16:
+                data = data.view(torch.int16)
+            f.write(data.numpy().tobytes())
+            written = end
+
+
+class TensorFile:
+    """memory-mapped reader of files written by save_file"""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        # copy-on-write mapping, tensors are writable but never touch the file
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+        header_size, = struct.unpack("<Q", self.mmap[:8])
+        header = json.loads(self.mmap[8:8 + header_size].decode("utf-8"))
+        self.metadata = header.pop("__metadata__", {})
+        self.header = header
+        self.data_start = 8 + header_size
+
+    def keys(self):
+        return self.header.keys()
+
+    def get_tensor(self, name):
+        info = self.header[name]
+        begin, end = info["data_offsets"]
+        dtype = TORCH_DTYPES[info["dtype"]]
+        if begin == end:
+            return torch.empty(info["shape"], dtype=dtype)
+        buffer = memoryview(self.mmap)[self.data_start + begin:self.data_start + end]
+        if (self.data_start + begin) % torch.empty((), dtype=dtype).element_size():
+            # files written elsewhere may not align their tensors
+            buffer = bytearray(buffer)
+        return torch.frombuffer(buffer, dtype=dtype).reshape(info["shape"])
+
+    def state_dict(self, prefixes=None, exclude=()):
+        """
+        materializes tensors whose names start with one of prefixes (all
+        when None), skipping names starting with one of exclude
+        """
+        sd = {}
+        for name in self.header:
+            if prefixes is not None and not name.startswith(tuple(prefixes)):
+                continue
+            if name.startswith(tuple(exclude)):
+                continue
+            sd[name] = self.get_tensor(name)
+        return sd
+
+    def close(self):
+        try:
+            self.mmap.close()
+        except BufferError:
+            # tensors still view the mapping, it goes away together with them
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,5 @@
+import os, sys
+
+# the scripts import each other by module name, like when run from scripts/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "scripts")]
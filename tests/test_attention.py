@@ -0,0 +1,13 @@
+"""memory estimates the attention autotuner picks backends by"""
+import torch
+from ldm.modules.attention import ATTENTION_BACKENDS
+
+
+def test_sliced_memory_counts_one_slice_of_scores():
+    q = torch.empty(16, 4096, 40)
+    k = v = torch.empty(16, 77, 40)
+    naive = ATTENTION_BACKENDS["naive"].memory(q, k, v)
+    output = 4 * 16 * 4096 * 40
+    for att_step in (1, 2, 4, 16):
+        sliced = ATTENTION_BACKENDS["sliced"].memory(q, k, v, att_step)
+        assert sliced == naive * att_step // 16 + output
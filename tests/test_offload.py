@@ -0,0 +1,90 @@
+"""
+Overlapped upload of the two UNet halves followed on the CPU: while one
+half computes the other one is already on its way, and device buffers
+are allocated once and reused on every step.
+"""
+import torch
+from offload import CPUBackend, OffloadEngine
+
+
+class EventBackend(CPUBackend):
+    """CPUBackend whose uploads return an event, so waits on them show up in the log"""
+    def __init__(self, log):
+        super().__init__()
+        self.log = log
+        self.units = {}
+
+    def alloc(self, nbytes):
+        buffer = torch.empty(nbytes, dtype=torch.uint8)
+        self.log.append(("alloc",))
+        return buffer
+
+    def upload(self, dst, src):
+        index = self.units[src.data_ptr()]
+        dst.copy_(src)
+        self.log.append(("upload", index))
+        return index
+
+    def wait(self, event):
+        self.log.append(("wait", event))
+
+
+class Half(torch.nn.Linear):
+    """stands in for model1 or model2 and logs when it computes"""
+    def __init__(self, index, log):
+        super().__init__(16, 16, bias=False)
+        self.index = index
+        self.log = log
+
+    def forward(self, x):
+        self.log.append(("compute", self.index))
+        return super().forward(x)
+
+
+def run_steps(budget_halves, steps=2):
+    torch.manual_seed(0)
+    log = []
+    halves = [Half(0, log), Half(1, log)]
+    half_bytes = 16 * 16 * 4
+    backend = EventBackend(log)
+    engine = OffloadEngine(halves, "cpu", budget=budget_halves * half_bytes, backend=backend)
+    backend.units = {unit.host.data_ptr(): index for index, unit in enumerate(engine.units)}
+    engine.attach()
+    x = torch.randn(2, 16)
+    with torch.no_grad():
+        for _ in range(steps):
+            out = halves[1](halves[0](x))
+    engine.detach()
+    return log, engine, out
+
+
+def test_next_half_uploads_while_the_current_one_computes():
+    log, engine, _ = run_steps(budget_halves=2)
+    assert log == [
+        ("alloc",), ("upload", 0), ("wait", 0),
+        # model2 is queued before model1 computes
+        ("alloc",), ("upload", 1),
+        ("compute", 0),
+        ("wait", 1), ("compute", 1),
+        # later steps find both halves resident
+        ("compute", 0), ("compute", 1),
+    ]
+    assert engine.used == engine.budget
+
+
+def test_one_half_budget_reuses_one_device_buffer():
+    log, engine, _ = run_steps(budget_halves=1)
+    step = [("upload", 0), ("wait", 0), ("compute", 0), ("upload", 1), ("wait", 1), ("compute", 1)]
+    assert log == [("alloc",)] + step + step
+    assert engine.used == engine.budget
+
+
+def test_offloaded_halves_compute_like_resident_ones():
+    torch.manual_seed(0)
+    log = []
+    halves = [Half(0, log), Half(1, log)]
+    x = torch.randn(2, 16)
+    with torch.no_grad():
+        expected = halves[1](halves[0](x))
+    _, _, out = run_steps(budget_halves=1)
+    torch.testing.assert_close(out, expected)
@@ -0,0 +1,91 @@
+"""
+Eviction policies of the block pager followed on the CPU through
+CPUBackend: four equally sized units under a budget of three, run in order
+for two passes.
+"""
+import pytest
+import torch
+from offload import CPUBackend, OffloadEngine
+
+
+UNIT_BYTES = 16 * 16 * 4
+
+
+class RecordingBackend(CPUBackend):
+    """CPUBackend which also logs the index of every uploaded unit"""
+    def __init__(self):
+        super().__init__()
+        self.units = {}
+        self.uploads = []
+
+    def upload(self, dst, src):
+        self.uploads.append(self.units[src.data_ptr()])
+        return super().upload(dst, src)
+
+
+def make_engine(policy, budget_units=3):
+    torch.manual_seed(0)
+    modules = [torch.nn.Linear(16, 16, bias=False) for _ in range(4)]
+    backend = RecordingBackend()
+    engine = OffloadEngine(modules, "cpu", budget=budget_units * UNIT_BYTES, policy=policy, backend=backend)
+    backend.units = {unit.host.data_ptr(): index for index, unit in enumerate(engine.units)}
+    return engine, backend
+
+
+def run_passes(engine, passes=2):
+    """activates every unit in order, returns the units evicted by each activation"""
+    evictions = []
+    for _ in range(passes):
+        for index in range(len(engine.units)):
+            before = set(engine.buffers)
+            engine.activate(index)
+            evictions.extend(sorted(before - set(engine.buffers)))
+            held = sum(buffer.nelement() for buffer in list(engine.buffers.values()) + engine.spare)
+            assert engine.used <= engine.budget
+            assert held <= engine.budget
+            assert index in engine.buffers
+    return evictions
+
+
+@pytest.mark.parametrize("policy, uploads, evictions", [
+    # the unit needed again last goes, unit 0 stays for the next pass
+    ("lookahead", [0, 1, 2, 3, 1, 3], [1, 3, 1]),
+    # the unit used longest ago goes, which cycles through all of them
+    ("lru", [0, 1, 2, 3, 0, 1, 2, 3, 0], [0, 1, 2, 3, 0, 1]),
+])
+def test_eviction_order(policy, uploads, evictions):
+    engine, backend = make_engine(policy)
+    assert run_passes(engine) == evictions
+    assert backend.uploads == uploads
+    # device buffers are reused, never more allocated than the budget holds
+    allocated = sum(entry[1] for entry in backend.log if entry[0] == "alloc")
+    assert allocated == engine.budget
+
+
+def test_budget_is_raised_to_the_largest_unit():
+    engine, backend = make_engine("lookahead", budget_units=0)
+    assert engine.budget == UNIT_BYTES
+    run_passes(engine)
+    assert backend.uploads == [0, 1, 2, 3] * 2
+
+
+def test_attached_modules_compute_like_resident_ones():
+    engine, _ = make_engine("lookahead", budget_units=2)
+    modules = [unit.module for unit in engine.units]
+    x = torch.randn(3, 16)
+    with torch.no_grad():
+        expected = x
+        for module in modules:
+            expected = module(expected)
+        engine.attach()
+        for _ in range(2):
+            out = x
+            for module in modules:
+                out = module(out)
+            torch.testing.assert_close(out, expected)
+    engine.detach()
+
+    engine.free()
+    assert engine.buffers == {} and engine.used == 0
+    for unit in engine.units:
+        assert unit.storage is unit.host
@@ -0,0 +1,143 @@
+"""
+The samplers of samplers.py against the guidance loop UNet.euler_sampling
+and the other k-sampling methods used to run inline, on CPU in fp32 with a
+small deterministic stand-in for the UNet.
+"""
+import pytest
+import torch
+from sampler_names import SAMPLER_NAMES
+from samplers import SAMPLERS, append_dims, append_zero, compvis_schedule, linear_multistep_coeff, run_sampler
+
+
+# at 10 steps t = 999, 888, ..., 0 hits the discrete noise levels exactly,
+# at 50 steps t lies between them and the interpolation is compared as well
+STEPS = [10, 50]
+SCALE = 7.5
+# every sampler is a few dozen fp32 ops per step on values of order one
+TOLERANCE = 1e-4
+
+
+def alphas_cumprod():
+    # same schedule as the v1 checkpoints
+    betas = torch.linspace(0.00085 ** 0.5, 0.0120 ** 0.5, 1000, dtype=torch.float64) ** 2
+    return torch.cumprod(1. - betas, dim=0).float()
+
+
+class ToyModel:
+    """fixed smooth function of x, t and the conditioning behind apply_model"""
+    def __init__(self):
+        generator = torch.Generator().manual_seed(0)
+        self.weight = torch.randn(4, 4, generator=generator) * 0.3
+
+    def apply_model(self, x, t, cond):
+        # scaled by t, so a timestep off by one changes the output by about 1e-3
+        mixed = torch.einsum("bchw,cd->bdhw", x, self.weight) * append_dims(1 + t / 1000, x.ndim)
+        return torch.tanh(mixed + append_dims(cond.mean(dim=(1, 2)), x.ndim))
+
+
+class BaselineDenoiser:
+    """
+    the guidance step of the removed UNet methods: CompVisDenoiser scalings
+    and its noise level <-> timestep mapping as they were, x and sigma
+    concatenated on every call
+    """
+    def __init__(self, model, alphas_cumprod, cond, uncond, scale):
+        self.model = model
+        self.sigmas = ((1 - alphas_cumprod) / alphas_cumprod) ** 0.5
+        self.cond = cond
+        self.uncond = uncond
+        self.scale = scale
+
+    def get_sigmas(self, n):
+        t = torch.linspace(len(self.sigmas) - 1, 0, n)
+        return append_zero(self.t_to_sigma(t))
+
+    def sigma_to_t(self, sigma):
+        dists = torch.abs(sigma - self.sigmas[:, None])
+        low_idx, high_idx = torch.sort(torch.topk(dists, dim=0, k=2, largest=False).indices, dim=0)[0]
+        low, high = self.sigmas[low_idx], self.sigmas[high_idx]
+        w = ((low - sigma) / (low - high)).clamp(0, 1)
+        return ((1 - w) * low_idx + w * high_idx).view(sigma.shape)
+
+    def t_to_sigma(self, t):
+        low_idx, high_idx, w = t.floor().long(), t.ceil().long(), t.frac()
+        return (1 - w) * self.sigmas[low_idx] + w * self.sigmas[high_idx]
+
+    def __call__(self, x, sigma):
+        x_in = torch.cat([x] * 2)
+        sigma_in = torch.cat([sigma] * 2)
+        c_out = append_dims(-sigma_in, x_in.ndim)
+        c_in = append_dims(1 / (sigma_in ** 2 + 1) ** 0.5, x_in.ndim)
+        eps = self.model.apply_model(x_in * c_in, self.sigma_to_t(sigma_in), torch.cat([self.uncond, self.cond]))
+        uncond, cond = (x_in + eps * c_out).chunk(2)
+        return uncond + self.scale * (cond - uncond)
+
+
+def seeded_noise(seed):
+    generator = torch.Generator().manual_seed(seed)
+    return lambda x: torch.randn(x.shape, generator=generator, dtype=x.dtype)
+
+
+@pytest.mark.parametrize("steps", STEPS)
+@pytest.mark.parametrize("name", sorted(SAMPLERS))
+def test_sampler_matches_baseline(name, steps):
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn(2, 4, 8, 8, generator=generator)
+    cond = torch.randn(2, 77, 16, generator=generator)
+    uncond = torch.randn(2, 77, 16, generator=generator)
+    model = ToyModel()
+    ac = alphas_cumprod()
+
+    baseline = BaselineDenoiser(model, ac, cond, uncond, SCALE)
+    sigmas = baseline.get_sigmas(steps)
+    kwargs = {"noise_sampler": seeded_noise(2)} if name.endswith("_a") else {}
+    expected = SAMPLERS[name](baseline, x * sigmas[0], sigmas, disable=True, **kwargs)
+
+    out = run_sampler(name, model, ac, x, steps, cond, uncond, SCALE, disable=True,
+                      noise_sampler=seeded_noise(2))
+
+    assert out.dtype == torch.float32
+    torch.testing.assert_close(out, expected, rtol=TOLERANCE, atol=TOLERANCE)
+
+
+def test_lms_coefficients_match_quadrature():
+    integrate = pytest.importorskip("scipy.integrate")
+    t = tuple(alphas_cumprod().flip(0)[::100].tolist())
+
+    def quadrature(order, i, j):
+        # how the coefficients were computed before the closed form
+        def fn(tau):
+            prod = 1.
+            for k in range(order):
+                if j != k:
+                    prod *= (tau - t[i - k]) / (t[i - j] - t[i - k])
+            return prod
+        return integrate.quad(fn, t[i], t[i + 1], epsrel=1e-4)[0]
+
+    for order in range(1, 5):
+        for i in range(order - 1, len(t) - 1):
+            for j in range(order):
+                assert linear_multistep_coeff(order, t, i, j) == pytest.approx(quadrature(order, i, j), rel=1e-4, abs=1e-8)
+
+
+def test_schedule_is_shared_between_copies():
+    ac = alphas_cumprod()
+    assert compvis_schedule(ac.clone()) is compvis_schedule(ac.clone())
+    assert compvis_schedule(ac.double()) is not compvis_schedule(ac)
+
+
+def test_sampler_names_match_registry():
+    # the command line lists these without importing torch
+    assert list(SAMPLERS) == SAMPLER_NAMES
+
+
+@pytest.mark.parametrize("steps", [10, 50, 37])
+def test_linear_schedule_matches_baseline(steps):
+    ac = alphas_cumprod()
+    baseline = BaselineDenoiser(None, ac, None, None, SCALE)
+    schedule = compvis_schedule(ac)
+    sigmas = schedule.get_sigmas(steps)
+    torch.testing.assert_close(sigmas, baseline.get_sigmas(steps), rtol=1e-6, atol=0)
+    # fractional t of the schedule map back to themselves
+    torch.testing.assert_close(schedule.sigma_to_t(sigmas[:-1]), baseline.sigma_to_t(sigmas[:-1]), rtol=0, atol=1e-4)
+    torch.testing.assert_close(schedule.sigma_to_t(sigmas[:-1]), torch.linspace(999, 0, steps), rtol=0, atol=1e-3)
@@ -0,0 +1,30 @@
+"""round trip of save_file and TensorFile with dtypes of every size"""
+import torch
+from tensorfile import ALIGNMENT, TensorFile, save_file
+
+
+def test_tensors_are_aligned_and_read_back(tmp_path):
+    torch.manual_seed(0)
+    tensors = {
+        "mask": torch.tensor([True, False, True]),
+        "ids": torch.arange(5, dtype=torch.int64),
+        "half": torch.randn(3, dtype=torch.float16),
+        "weight": torch.randn(3, 5),
+        "bf16": torch.randn(7, dtype=torch.bfloat16),
+        "empty": torch.zeros(0, 4),
+        "bytes": torch.arange(3, dtype=torch.uint8),
+        "double": torch.randn(2, 2, dtype=torch.float64),
+    }
+    path = tmp_path / "model.safetensors"
+    save_file(tensors, path, metadata={"format": "pt"})
+
+    with TensorFile(path) as tf:
+        assert tf.metadata == {"format": "pt"}
+        assert tf.data_start % ALIGNMENT == 0
+        for name, tensor in tensors.items():
+            begin, _ = tf.header[name]["data_offsets"]
+            assert begin % ALIGNMENT == 0
+            loaded = tf.get_tensor(name)
+            assert loaded.dtype == tensor.dtype
+            assert torch.equal(loaded, tensor)
+            del loaded
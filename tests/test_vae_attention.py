@@ -0,0 +1,103 @@
+"""
+Chunked attention of the VAE and tiled decoding on the CPU, with a small
+randomly initialised autoencoder of the same architecture as the real one.
+"""
+import pytest
+import torch
+import torch.nn.functional as F
+from omegaconf import OmegaConf
+from ddpm import FirstStage
+from ldm.modules.diffusionmodules.model import AttnBlock, attn_chunking, set_attn_chunking
+
+
+def tiny_first_stage():
+    config = OmegaConf.create({
+        "target": "ldm.models.autoencoder.AutoencoderKL",
+        "params": {
+            "embed_dim": 4,
+            "ddconfig": {
+                "double_z": True,
+                "z_channels": 4,
+                "resolution": 64,
+                "in_channels": 3,
+                "out_ch": 3,
+                "ch": 32,
+                "ch_mult": [1, 2],
+                "num_res_blocks": 1,
+                "attn_resolutions": [],
+                "dropout": 0.0,
+            },
+            "lossconfig": {"target": "torch.nn.Identity"},
+        },
+    })
+    torch.manual_seed(0)
+    return FirstStage(config, timesteps=1000, scale_factor=0.18215).eval()
+
+
+class NearestDecoder(torch.nn.Module):
+    """decoder where every latent pixel only affects its own output pixels"""
+    def __init__(self, factor):
+        super().__init__()
+        self.factor = factor
+
+    def decode(self, z):
+        return torch.tanh(F.interpolate(z[:, :3], scale_factor=self.factor, mode="nearest"))
+
+
+@pytest.mark.parametrize("query_chunk, key_chunk", [(16, None), (10, 7), (64, 64), (100, None)])
+def test_chunked_attn_block_matches_full(query_chunk, key_chunk):
+    torch.manual_seed(0)
+    block = AttnBlock(32).eval()
+    x = torch.randn(2, 32, 8, 8)
+    with torch.no_grad():
+        expected = block(x)
+        set_attn_chunking(block, query_chunk, key_chunk)
+        chunked = block(x)
+        set_attn_chunking(block)
+        with attn_chunking(query_chunk, key_chunk):
+            scoped = block(x)
+        # the scope wins over what is set on the module
+        set_attn_chunking(block, query_chunk, key_chunk)
+        with attn_chunking(None):
+            unscoped = block(x)
+    torch.testing.assert_close(chunked, expected, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(scoped, expected, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(unscoped, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_chunked_decode_matches_full():
+    model = tiny_first_stage()
+    z = torch.randn(1, 4, 16, 12)
+    with torch.no_grad():
+        expected = model.decode_first_stage(z)
+        with attn_chunking(48, 40):
+            chunked = model.decode_first_stage(z)
+    torch.testing.assert_close(chunked, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_tiled_decode_with_one_tile_matches_untiled():
+    model = tiny_first_stage()
+    z = torch.randn(2, 4, 16, 12)
+    with torch.no_grad():
+        expected = model.decode_first_stage(z)
+        tiled = model.decode_first_stage_tiled(z, 2**40)
+    torch.testing.assert_close(tiled, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_tiled_decode_blends_overlapping_tiles():
+    model = tiny_first_stage()
+    model.first_stage_model = NearestDecoder(2 ** model.num_downs)
+    z = torch.randn(2, 4, 40, 24)
+    # a budget of one byte makes every tile as small as min_tile
+    assert model.tile_size(z, 1) == model.tile_params["min_tile"] < z.shape[2]
+    with torch.no_grad():
+        expected = model.decode_first_stage(z)
+        tiled = model.decode_first_stage_tiled(z, 1)
+    assert tiled.shape == expected.shape
+    torch.testing.assert_close(tiled, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("h, w, tile", [(20, 20, 16), (44, 12, 16), (12, 8, 12)])
+def test_tile_size_never_drops_below_min_tile(h, w, tile):
+    model = tiny_first_stage()
+    assert model.tile_size(torch.zeros(1, 4, h, w), 1) == tile